@@ -1,29 +1,35 @@
 import hax
+from telemetry_helpers import TelemetryMixin
+from field_helpers import basic_fields, required_branches, extract_fields, \
+    assign_peak_roles, dataset_number
 
-class Kr83m_Basic(hax.minitrees.TreeMaker):
+class Kr83m_Basic(TelemetryMixin, hax.minitrees.TreeMaker):
     
     __version__ = '0.0.1'
-    extra_branches = ['dataset_name','peaks.n_contributing_channels','peaks.hit_time_mean']
+    # number of extra S1/S2 peaks (s12, s13, ... / s22, s23, ...) to store
+    n_stray = 1
+    fields = basic_fields(n_stray)
+    extra_branches = required_branches(fields)
+    
+    def __init__(self, *args, **kwargs):
+        # rebuilt from n_stray, so a subclass only has to change that; hax
+        # builds the branch selection from extra_branches, so before super
+        self.fields = basic_fields(self.n_stray)
+        self.extra_branches = required_branches(self.fields)
+        super(Kr83m_Basic, self).__init__(*args, **kwargs)
     
     def extract_data(self, event):
         
+        access_seconds = self.telemetry.event()
+        
         # If there are no interactions at all, we can't extract anything...
         if not len(event.interactions):
+            self.telemetry.reject('no_interactions')
             return dict()
         
-        # Extract dataset_number
-        dsetname = event.dataset_name
-        if dsetname.endswith('.xed'):
-            filename = dsetname.split("/")[-1]
-            _, date, time, _ = filename.split('_')
-            dataset_number = int(date) * 1e4 + int(time)
-        else:
-            # TODO: XENON1T support
-            dataset_number = 0
-            
         event_data = dict(event_number=event.event_number,
                           event_time=event.start_time,
-                          dataset_number=dataset_number)
+                          dataset_number=dataset_number(event.dataset_name))
         
         # shortcuts for pax classes
         peaks = event.peaks
@@ -51,76 +57,18 @@ class Kr83m_Basic(hax.minitrees.TreeMaker):
             s11 = interactions[krInt[0]].s1
             s21 = -1
             sInt = krInt[0]
-        else: return dict()
+        else:
+            self.telemetry.reject('no_second_s1')
+            return dict()
                 
         # Find additional unwanted peaks
-        s12 = -1
-        for s1 in event.s1s:
-            if s1 not in [s10,s11]: 
-                s12 = s1
-                break
-        s22 = -1
-        for s2 in event.s2s:
-            if s2 not in [s20,s21]:
-                s22 = s2
-                break
+        _, roles = assign_peak_roles(len(peaks), event.s1s, event.s2s,
+                                     dict(s10=s10, s11=s11, s20=s20, s21=s21), self.n_stray)
                 
         ##### Grab Data #####
     
-        event_data.update(dict( s10Area = peaks[s10].area,
-                                cs10Area = peaks[s10].area*interactions[0].s1_area_correction,
-                                s10Coin = peaks[s10].n_contributing_channels,
-                                s10Time = peaks[s10].hit_time_mean,
-                                s10x = interactions[0].x,
-                                s10y = interactions[0].y,
-                                s10z = interactions[0].z,
-                                s20Area = peaks[s20].area,
-                                cs20Area = peaks[s20].area*interactions[0].s2_area_correction,
-                                s20Coin = peaks[s20].n_contributing_channels,
-                                s20Time = peaks[s20].hit_time_mean,
-                                s11Area = peaks[s11].area,
-                                cs11Area = peaks[s11].area*interactions[sInt].s1_area_correction,
-                                s11Coin = peaks[s11].n_contributing_channels,
-                                s11Time = peaks[s11].hit_time_mean,
-                                s11x = interactions[sInt].x,
-                                s11y = interactions[sInt].y,
-                                s11z = interactions[sInt].z ))
-    
-        if s21 != -1:
-            s21Area = peaks[s21].area
-            s21Coin = peaks[s21].n_contributing_channels
-            s21Time = peaks[s21].hit_time_mean
-        else:
-            s21Area = 0
-            s21Coin = 0
-            s21Time = 0
-    
-        if s12 != -1:
-            s12Area = peaks[s12].area
-            s12Coin = peaks[s12].n_contributing_channels
-            s12Time = peaks[s12].hit_time_mean
-        else:
-            s12Area = 0
-            s12Coin = 0
-            s12Time = 0
-        
-        if s22 != -1:
-            s22Area = peaks[s22].area
-            s22Coin = peaks[s22].n_contributing_channels
-            s22Time = peaks[s22].hit_time_mean
-        else:
-            s22Area = 0
-            s22Coin = 0
-            s22Time = 0
-            
-        event_data.update(dict( s21Area = s21Area,
-                                s21Coin = s21Coin,
-                                s21Time = s21Time,
-                                s12Area = s12Area,
-                                s12Coin = s12Coin,
-                                s12Time = s12Time,
-                                s22Area = s22Area,
-                                s22Coin = s22Coin,
-                                s22Time = s22Time ))
+        event_data.update(extract_fields(self.fields, peaks, roles,
+                                         dict(i0=interactions[0], i1=interactions[sInt]),
+                                         access_seconds))
         
         return event_data        
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import types
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+
+# Throughput benchmark for the Kr83m extraction paths on synthetic events,
+# so it runs without pax data (and without hax: if hax cannot be imported a
+# bare stand-in providing hax.minitrees.TreeMaker is registered, which is all
+# the tree maker modules need at import time).
+#
+#   python benchmark_helpers.py --events 10000 100000 1000000
+#
+# Results are appended to benchmark_results.jsonl and compared with the last
+# run of the same configuration.
+#
+#   python benchmark_helpers.py --imports
+#
+# times the import of the analysis helper modules instead; none of them may
+# pull in ROOT at import time.
+
+##################################################################################################
+
+class SyntheticPeak(object):
+    __slots__ = ['area', 'n_contributing_channels', 'hit_time_mean', 'left', 'right']
+
+class SyntheticInteraction(object):
+    __slots__ = ['s1', 's2', 'x', 'y', 'z', 's1_area_correction', 's2_area_correction']
+
+class SyntheticEvent(object):
+    __slots__ = ['event_number', 'start_time', 'dataset_name', 'peaks', 'interactions', 's1s', 's2s']
+
+def _peak(rng, area, time):
+    peak = SyntheticPeak()
+    peak.area = area
+    peak.n_contributing_channels = int(rng.integers(2, 100))
+    peak.hit_time_mean = time
+    peak.left = int(time/10.0) - 5
+    peak.right = int(time/10.0) + 5
+    return peak
+
+def _interaction(rng, s1, s2):
+    interaction = SyntheticInteraction()
+    interaction.s1 = s1
+    interaction.s2 = s2
+    interaction.x, interaction.y = rng.uniform(-30, 30, 2)
+    interaction.z = rng.uniform(-96.7, 0)
+    interaction.s1_area_correction = rng.uniform(1.0, 1.5)
+    interaction.s2_area_correction = rng.uniform(1.0, 3.0)
+    return interaction
+
+def make_events(n_events, n_peaks=6, n_interactions=3, double_s2_fraction=0.3,
+                dataset_name='xe100_160807_1645_000000.xed', seed=0):
+
+    # Kr83m-like events: a 32.1 keV S1 followed by a 9.4 keV S1 (500-2000 ns
+    # later), one merged S2 or two S2s (double_s2_fraction of the events),
+    # stray peaks up to n_peaks and interactions up to n_interactions
+    rng = np.random.default_rng(seed)
+    events = []
+
+    for i in range(n_events):
+
+        double = rng.random() < double_s2_fraction
+        t0 = rng.uniform(1e5, 2e5)
+        dt = rng.uniform(500, 2000)
+        drift = rng.uniform(1e3, 7e5)
+
+        s1s = [(rng.normal(200, 20), t0), (rng.normal(60, 8), t0 + dt)]
+        s2s = [(rng.normal(2e4, 2e3), t0 + drift)]
+        if double:
+            s2s.append((rng.normal(6e3, 6e2), t0 + drift + dt))
+        n_stray = max(n_peaks - len(s1s) - len(s2s), 0)
+        for j in range(n_stray):
+            if rng.random() < 0.5:
+                s1s.append((rng.exponential(5), rng.uniform(0, 1e6)))
+            else:
+                s2s.append((rng.exponential(100), rng.uniform(0, 1e6)))
+
+        peaks = [_peak(rng, area, t) for area, t in s1s + s2s]
+        s1_idx = list(range(len(s1s)))
+        s2_idx = list(range(len(s1s), len(peaks)))
+
+        # pax sorts s1s / s2s by area
+        s1_by_area = sorted(s1_idx, key=lambda p: -peaks[p].area)
+        s2_by_area = sorted(s2_idx, key=lambda p: -peaks[p].area)
+
+        # (s10, s20), (s11, s20) and for double S2 events (s11, s21)
+        pairs = [(0, s2_idx[0]), (1, s2_idx[0])]
+        if double:
+            pairs.append((1, s2_idx[1]))
+        for s1 in s1_by_area:
+            for s2 in s2_by_area:
+                if len(pairs) >= n_interactions:
+                    break
+                if (s1, s2) not in pairs:
+                    pairs.append((s1, s2))
+        interactions = [_interaction(rng, s1, s2) for s1, s2 in pairs[:max(n_interactions, 1)]]
+
+        event = SyntheticEvent()
+        event.event_number = i
+        event.start_time = int(1.47e18) + i*int(1e7)
+        event.dataset_name = dataset_name
+        event.peaks = peaks
+        event.interactions = interactions
+        event.s1s = s1_by_area
+        event.s2s = s2_by_area
+        events.append(event)
+
+    return events
+
+##################################################################################################
+
+def _import_treemakers():
+    try:
+        import hax
+    except ImportError:
+        hax = types.ModuleType('hax')
+        hax.minitrees = types.ModuleType('hax.minitrees')
+        hax.minitrees.TreeMaker = type('TreeMaker', (object,), dict(__version__='0'))
+        sys.modules['hax'] = hax
+        sys.modules['hax.minitrees'] = hax.minitrees
+    from Kr83m_Basic import Kr83m_Basic
+    from Kr83m_Basic_v3 import Kr83m_Basic_v3
+    return Kr83m_Basic, Kr83m_Basic_v3
+
+def _make_treemaker(treemaker):
+    # skip hax's TreeMaker.__init__, extract_data only needs the telemetry
+    from telemetry_helpers import Telemetry
+    tm = treemaker.__new__(treemaker)
+    tm.telemetry = Telemetry('benchmark', tm)
+    return tm
+
+def _chunks(events, n_events):
+    # cycle over the synthetic pool until n_events have been handed out
+    done = 0
+    while done < n_events:
+        chunk = events[:min(len(events), n_events - done)]
+        done += len(chunk)
+        yield chunk
+
+def benchmark_paths():
+
+    import batch_helpers
+    import pairing_helpers
+    Kr83m_Basic, Kr83m_Basic_v3 = _import_treemakers()
+
+    def per_event(treemaker):
+        tm = _make_treemaker(treemaker)
+        def run(chunk):
+            for event in chunk:
+                tm.extract_data(event)
+        return run
+
+    def batch(chunk):
+        batch_helpers.extract_batch(batch_helpers.flatten_events(chunk))
+
+    def pairing(chunk):
+        pairing_helpers.pair_events_df(batch_helpers.flatten_events(chunk))
+
+    return [('Kr83m_Basic', per_event(Kr83m_Basic)),
+            ('Kr83m_Basic_v3', per_event(Kr83m_Basic_v3)),
+            ('Kr83m_Basic_v3.batch', batch),
+            ('pairing', pairing)]
+
+def run_benchmark(n_events_list=(10000, 100000), pool_size=10000, paths=None, **event_kwargs):
+
+    pool = make_events(pool_size, **event_kwargs)
+    results = []
+    for name, run in benchmark_paths():
+        if paths is not None and name not in paths:
+            continue
+        for n_events in n_events_list:
+            start = time.time()
+            for chunk in _chunks(pool, int(n_events)):
+                run(chunk)
+            seconds = time.time() - start
+            results.append(dict(path=name, n_events=int(n_events), seconds=seconds,
+                                events_per_s=int(n_events)/seconds))
+            print('%-22s %10d events %8.2f s %12.0f events/s'
+                  %(name, n_events, seconds, int(n_events)/seconds))
+    return results
+
+##################################################################################################
+
+# modules whose numeric functions must import without ROOT
+IMPORT_MODULES = ['cut_helpers', 'lce_helpers_v2', 'xerawdp_helpers', 'root_helpers']
+IMPORT_LIMIT_MS = 100.0
+
+_IMPORT_SNIPPET = '''
+import sys, time, json
+import numpy
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps(dict(seconds=seconds, root_loaded='ROOT' in sys.modules)))
+'''
+
+def time_import(module, repeat=5):
+
+    # best of repeat fresh interpreters, numpy is imported beforehand since
+    # every notebook has it loaded already
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_SNIPPET % module], cwd=here)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+def run_import_benchmark(modules=IMPORT_MODULES, repeat=5, limit_ms=IMPORT_LIMIT_MS):
+
+    results = []
+    for module in modules:
+        result = time_import(module, repeat)
+        ms = 1e3*result['seconds']
+        ok = ms < limit_ms and not result['root_loaded']
+        results.append(dict(path='import '+module, import_ms=ms, root_loaded=result['root_loaded'], ok=ok))
+        print('%-22s %8.1f ms  ROOT %-10s %s' %(module, ms,
+              'loaded' if result['root_loaded'] else 'not loaded', 'ok' if ok else 'FAIL'))
+    return results
+
+##################################################################################################
+
+def record_results(results, config, out_file='benchmark_results.jsonl'):
+
+    # append this run and report the change w.r.t. the last run with the same config
+    previous = dict()
+    if os.path.exists(out_file):
+        with open(out_file) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['config'] == config and 'events_per_s' in entry:
+                    previous[(entry['path'], entry['n_events'])] = entry['events_per_s']
+
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    with open(out_file, 'a') as f:
+        for result in results:
+            entry = dict(result, config=config, time=stamp, python=platform.python_version(),
+                         numpy=np.__version__, host=platform.node())
+            f.write(json.dumps(entry, sort_keys=True)+'\n')
+            key = (result['path'], result.get('n_events'))
+            if key in previous:
+                print('%-22s %10d events: %.2fx previous throughput'
+                      %(key[0], key[1], result['events_per_s']/previous[key]))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Kr83m extraction throughput benchmark')
+    parser.add_argument('--events', type=float, nargs='+', default=[1e4, 1e5])
+    parser.add_argument('--pool', type=int, default=10000)
+    parser.add_argument('--peaks', type=int, default=6)
+    parser.add_argument('--interactions', type=int, default=3)
+    parser.add_argument('--double-s2-fraction', type=float, default=0.3)
+    parser.add_argument('--paths', nargs='+', default=None)
+    parser.add_argument('--out', default='benchmark_results.jsonl')
+    parser.add_argument('--imports', action='store_true',
+                        help='time the helper module imports instead (must stay under %d ms without ROOT)'
+                        % IMPORT_LIMIT_MS)
+    args = parser.parse_args()
+
+    if args.imports:
+        results = run_import_benchmark()
+        record_results(results, dict(imports=IMPORT_MODULES), args.out)
+        sys.exit(0 if all(result['ok'] for result in results) else 1)
+
+    config = dict(pool=args.pool, peaks=args.peaks, interactions=args.interactions,
+                  double_s2_fraction=args.double_s2_fraction)
+    results = run_benchmark([int(n) for n in args.events], args.pool, args.paths,
+                            n_peaks=args.peaks, n_interactions=args.interactions,
+                            double_s2_fraction=args.double_s2_fraction)
+    record_results(results, config, args.out)
@@ -1,16 +1,44 @@
-import ROOT
+from lazy_helpers import ROOT, pd
 import numpy as  np
 
+from derived_helpers import column
+
+def fill_hist(hist, values):
+    
+    # hist.Fill(x) for every x in values, for a new histogram with fixed bins:
+    # bin numbers (under / overflow included) come from one numpy pass using
+    # ROOT's TAxis::FindBin formula, then contents, entries and the stats are
+    # set bin by bin instead of event by event. Errors are left to ROOT
+    # (sqrt(content) until hist.Sumw2(), which then stores the same), as
+    # with Fill. As in TAxis::FindBin, NaNs go to the overflow bin (and count
+    # as entries, but not in the stats).
+    values = np.asarray(values, dtype=np.float64)
+    
+    axis = hist.GetXaxis()
+    n_bins, x_min, x_max = axis.GetNbins(), axis.GetXmin(), axis.GetXmax()
+    
+    # every comparison with NaN is False
+    inside = (values >= x_min) & (values < x_max)
+    bins = np.where(values < x_min, 0, n_bins+1)
+    bins[inside] = 1 + (n_bins*(values[inside]-x_min)/(x_max-x_min)).astype(np.int64)
+    counts = np.bincount(bins, minlength=n_bins+2)
+    
+    for i in range(n_bins+2):
+        hist.SetBinContent(i, counts[i])
+    hist.SetEntries(len(values))
+    
+    # sum of weights, of squared weights, of w*x and of w*x^2 (in range only)
+    x = values[inside]
+    hist.PutStats(np.array([len(x), len(x), x.sum(), (x*x).sum()], dtype=np.float64))
+    return hist
+
 def cut_compare(df_xerawdp,df_pax,cut_info):
     
     key, cut_min, cut_max, bins, x_min, x_max, units = cut_info
     figure = './KrLce_Figures/f_'+key+'Hists.png'
     
-    xerawdp_total = len(df_xerawdp.values)
-    pax_total = len(df_pax.values)
-    
-    df_xerawdp_new = df_xerawdp
-    df_pax_new = df_pax
+    xerawdp_total = len(df_xerawdp)
+    pax_total = len(df_pax)
     
     # Create and fill hists
     hists = []
@@ -22,8 +50,7 @@ def cut_compare(df_xerawdp,df_pax,cut_info):
         else:
             df = df_pax
             title = 'Pax'
-        for j in range(len(df.values)):
-            hists[i].Fill(df[key].values[j])
+        fill_hist(hists[i], column(df, key))
             
         hists[i].GetXaxis().SetTitle('%s (%s)'%(key,units))
         hists[i].GetXaxis().CenterTitle()
@@ -43,9 +70,6 @@ def cut_compare(df_xerawdp,df_pax,cut_info):
         
         cut_str += str(cut_min)+' <= '
         
-        df_xerawdp_new = df_xerawdp_new[ df_xerawdp_new[key]>=cut_min ]
-        df_pax_new = df_pax_new[ df_pax_new[key]>=cut_min ]
-        
     cut_str += key
             
     if cut_max != 'none':
@@ -55,12 +79,10 @@ def cut_compare(df_xerawdp,df_pax,cut_info):
         cut_lines[len(cut_lines)-1].SetLineWidth(3)
         
         cut_str += ' <= '+str(cut_max)
-        
-        df_xerawdp_new = df_xerawdp_new[ df_xerawdp_new[key]<=cut_max ]
-        df_pax_new = df_pax_new[ df_pax_new[key]<=cut_max ]
                     
-    xerawdp_acceptance = len(df_xerawdp_new.values)/xerawdp_total
-    pax_acceptance = len(df_pax_new.values)/pax_total
+    cut = CutSet([cut_info])
+    xerawdp_acceptance = cut.mask(df_xerawdp).sum()/xerawdp_total
+    pax_acceptance = cut.mask(df_pax).sum()/pax_total
     acceptance_ratios = [xerawdp_acceptance,pax_acceptance]
             
     c1 = ROOT.TCanvas('','',1600,700)
@@ -92,16 +114,13 @@ def cut_review(df_pax,cut_info):
     key, cut_min, cut_max, bins, x_min, x_max, units = cut_info
     figure = './KrLce_Figures/f_'+key+'Hists.png'
     
-    pax_total = len(df_pax.values)
-    
-    df_pax_new = df_pax
+    pax_total = len(df_pax)
     
     # Create and fill hists
     hist = ROOT.TH1D('','',bins,x_min,x_max)
     df = df_pax
     title = 'Pax'
-    for j in range(len(df.values)):
-        hist.Fill(df[key].values[j])
+    fill_hist(hist, column(df, key))
             
     hist.GetXaxis().SetTitle('%s (%s)'%(key,units))
     hist.GetXaxis().CenterTitle()
@@ -120,7 +139,6 @@ def cut_review(df_pax,cut_info):
         cut_lines[len(cut_lines)-1].SetLineWidth(3)
         
         cut_str += str(cut_min)+' <= '
-        df_pax_new = df_pax_new[ df_pax_new[key]>=cut_min ]
         
     cut_str += key
             
@@ -131,10 +149,8 @@ def cut_review(df_pax,cut_info):
         cut_lines[len(cut_lines)-1].SetLineWidth(3)
         
         cut_str += ' <= '+str(cut_max)
-        
-        df_pax_new = df_pax_new[ df_pax_new[key]<=cut_max ]
                     
-    pax_acceptance = len(df_pax_new.values)/pax_total
+    pax_acceptance = CutSet([cut_info]).mask(df_pax).sum()/pax_total
             
     c1 = ROOT.TCanvas('','',1600,700)
     ROOT.gStyle.SetOptStat(0)
@@ -156,39 +172,311 @@ def cut_review(df_pax,cut_info):
     return figure
 
 
+class CutSet(object):
+    
+    # Cuts given as [key, min, max, bins, x_min, x_max, units] lists ('none'
+    # for an open side), compiled once into (key, min, max) bounds with None
+    # for the open sides. All bounds are evaluated into one boolean mask over
+    # the column arrays, so the table is copied once however many cuts there are.
+    
+    def __init__(self, cuts):
+        self.cuts = [list(cut) for cut in cuts]
+        self.bounds = [(cut[0], None if cut[1] == 'none' else cut[1],
+                        None if cut[2] == 'none' else cut[2]) for cut in self.cuts]
+        
+    def __len__(self):
+        return len(self.cuts)
+    
+    def __iter__(self):
+        return iter(self.cuts)
+    
+    def cut_mask(self, df, i):
+        # events passing cut i alone
+        key, cut_min, cut_max = self.bounds[i]
+        values = column(df, key)
+        mask = np.ones(len(values), dtype=bool)
+        if cut_min is not None:
+            mask &= values >= cut_min
+        if cut_max is not None:
+            mask &= values <= cut_max
+        return mask
+    
+    def mask(self, df):
+        mask = np.ones(len(df), dtype=bool)
+        for i in range(len(self.bounds)):
+            mask &= self.cut_mask(df, i)
+        return mask
+    
+    def index(self, df):
+        return df.index[self.mask(df)]
+    
+    def apply(self, df):
+        return df[self.mask(df)]
+    
+    def bitmask(self, df):
+        # bit i set for the events passing cut i, one uint32 (uint64 beyond
+        # 32 cuts) per event; can be kept as a column of df
+        if len(self.cuts) > 64:
+            raise ValueError('at most 64 cuts fit in a bitmask, got %d' % len(self.cuts))
+        dtype = np.uint32 if len(self.cuts) <= 32 else np.uint64
+        bits = np.zeros(len(df), dtype=dtype)
+        for i in range(len(self.bounds)):
+            bits |= self.cut_mask(df, i).astype(dtype) << dtype(i)
+        return bits
+    
+    def cut_flow(self, df):
+        return CutFlow(self.bitmask(df), len(self.cuts))
+    
+    def find(self, key):
+        # index of the first cut on key
+        for i, bound in enumerate(self.bounds):
+            if bound[0] == key:
+                return i
+        raise KeyError(key)
+
+def subset_bits(cuts):
+    # bitmask selecting the cut indices in cuts
+    bits = 0
+    for i in cuts:
+        bits |= 1 << int(i)
+    return bits
+
+def passes(bits, cuts):
+    # events of a CutSet.bitmask column passing every cut index in cuts
+    subset = bits.dtype.type(subset_bits(cuts))
+    return (bits & subset) == subset
+
+class CutFlow(object):
+    
+    # Acceptances from a CutSet.bitmask column. The events are reduced once to
+    # the distinct pass patterns and their counts; N-1 acceptances, the
+    # sequential cut flow, the overlaps and the acceptance of any subset of
+    # cuts are then sums over those patterns, without the original columns.
+    
+    def __init__(self, bits, n_cuts):
+        self.n_cuts = n_cuts
+        self.n_events = len(bits)
+        self.patterns, self.counts = np.unique(bits, return_counts=True)
+        self.patterns = self.patterns.astype(np.uint64)
+        
+    def passing(self, cuts=None):
+        # number of events passing all cut indices in cuts (all cuts if None)
+        if cuts is None:
+            cuts = range(self.n_cuts)
+        subset = np.uint64(subset_bits(cuts))
+        return int(self.counts[(self.patterns & subset) == subset].sum())
+    
+    def acceptance(self, cuts=None):
+        return self.passing(cuts)/self.n_events if self.n_events else 0.0
+    
+    def n1(self):
+        # events passing all cuts but cut i, the last entry all cuts
+        everything = list(range(self.n_cuts))
+        return np.array([self.passing(everything[:i]+everything[i+1:]) for i in range(self.n_cuts)]
+                        + [self.passing(everything)])
+    
+    def flow(self):
+        # events left after each of the cuts applied in order, the first
+        # entry before any cut
+        return np.array([self.passing(range(k)) for k in range(self.n_cuts+1)])
+    
+    def overlap(self):
+        # [i, j]: events rejected by both cut i and cut j, the diagonal
+        # the events rejected by cut i
+        shifts = np.arange(self.n_cuts, dtype=np.uint64)
+        fails = ((~self.patterns[:, None] >> shifts) & np.uint64(1)).astype(np.int64)
+        return np.dot((fails*self.counts[:, None]).T, fails)
+
+def compile_cuts(cuts):
+    return cuts if isinstance(cuts, CutSet) else CutSet(cuts)
+
 def apply_cuts(df,cuts):
     
-    df_new = df
+    # cuts: list of cut lists or a CutSet
+    return compile_cuts(cuts).apply(df)
+
+class ThresholdScan(object):
     
-    for cut in cuts:
-                    
-        key, cut_min, cut_max, bins, x_min, x_max, units = cut
-        if cut_min != 'none':
-            df_new = df_new[ df_new[key]>=cut_min]
-        if cut_max != 'none':
-            df_new = df_new[ df_new[key]<=cut_max]
-            
-    return df_new
+    # Values of the variable of cut i for the events passing all other cuts,
+    # sorted once. The number of events passing any min / max threshold is
+    # then a pair of binary searches, so scanning a cut over many values
+    # costs about as much as applying it once.
+    
+    def __init__(self, df, cuts, i):
+        cuts = compile_cuts(cuts)
+        if not isinstance(i, (int, np.integer)):
+            i = cuts.find(i)
+        self.key, self.cut_min, self.cut_max = cuts.bounds[i]
+        
+        others = CutSet([cut for j, cut in enumerate(cuts) if j != i])
+        values = column(df, self.key)[others.mask(df)]
+        self.n_events = len(values)
+        self.values = np.sort(values[~np.isnan(values)])
+        
+    def n_passing(self, low, high):
+        # events with low <= value <= high, None for an open side
+        n_low = 0 if low is None else np.searchsorted(self.values, low, side='left')
+        n_high = len(self.values) if high is None else np.searchsorted(self.values, high, side='right')
+        return np.maximum(n_high - n_low, 0)
+    
+    def _acceptance(self, n):
+        return n/float(self.n_events) if self.n_events else np.zeros(np.shape(n))
+    
+    def scan_min(self, thresholds):
+        # acceptance with the min moved to each threshold, the max kept
+        return self._acceptance(self.n_passing(np.asarray(thresholds), self.cut_max))
+    
+    def scan_max(self, thresholds):
+        # acceptance with the max moved to each threshold, the min kept
+        return self._acceptance(self.n_passing(self.cut_min, np.asarray(thresholds)))
 
-def n1_cuts(df,cuts):
+def scan_cut(dfs, cuts, i, thresholds=None, n_points=1000):
+    
+    # Acceptance vs. threshold of cut i (index or key) relative to the events
+    # passing the other cuts, for both bounds and every dataframe in dfs,
+    # e.g. dict(xerawdp=df_xerawdp, pax=df_pax): columns <name>_min and
+    # <name>_max. The thresholds default to n_points over the cut's x range.
+    cuts = compile_cuts(cuts)
+    if not isinstance(i, (int, np.integer)):
+        i = cuts.find(i)
+    if thresholds is None:
+        key, cut_min, cut_max, bins, x_min, x_max, units = cuts.cuts[i]
+        thresholds = np.linspace(x_min, x_max, n_points)
     
-    acceptances = np.zeros(len(cuts)+1)
+    columns = [('threshold', np.asarray(thresholds))]
+    for name, df in dfs.items():
+        scan = ThresholdScan(df, cuts, i)
+        columns += [(name+'_min', scan.scan_min(thresholds)), (name+'_max', scan.scan_max(thresholds))]
+    return pd.DataFrame(dict(columns), columns=[name for name, _ in columns])
+
+class CutOptimizer(object):
+    
+    # Joint optimization of the cut values. The cut variables are binned once
+    # into an N-dimensional count histogram using the bins / x range of each
+    # cut list (bins overrides them all), with under- and overflow bins, and
+    # cumulatively summed along every axis. The events inside any box of
+    # thresholds are then 2^N lookups, whatever the number of events, so
+    # thousands of threshold combinations are scored in one vectorized pass.
+    # Candidate thresholds are the bin edges. Every edge gets a cell of its
+    # own for the values sitting exactly on it, so min and max thresholds are
+    # both inclusive, as in CutSet / apply_cuts. NaNs fail every bound.
     
-    for i in range(len(cuts)+1):
+    max_cells = int(1e8)
+    
+    def __init__(self, df, cuts, bins=None):
+        self.cuts = compile_cuts(cuts)
+        self.n_events = len(df)
+        self.edges = []
         
-        df_new = df
+        indices = []
+        valid = np.ones(len(df), dtype=bool)
+        for key, cut_min, cut_max, n_bins, x_min, x_max, units in self.cuts:
+            edges = np.linspace(x_min, x_max, (bins or n_bins)+1)
+            values = column(df, key).astype(np.float64)
+            nan = np.isnan(values)
+            if cut_min != 'none' or cut_max != 'none':
+                valid &= ~nan
+            # 2k for edges[k-1] < value < edges[k] (0 below edges[0], 2*len(edges)
+            # above the last edge), 2k+1 for value == edges[k]
+            index = np.searchsorted(edges, values, side='left') + np.searchsorted(edges, values, side='right')
+            index[nan] = 0
+            indices.append(index)
+            self.edges.append(edges)
         
-        for j, cut in enumerate(cuts):
-            
-            if i==j: continue
-            
-            key, cut_min, cut_max, bins, x_min, x_max, units = cut
-            
-            if cut_min != 'none':
-                df_new = df_new[ df_new[key]>=cut_min ]
-            if cut_max != 'none':
-                df_new = df_new[ df_new[key]<=cut_max ]
-                
-        acceptances[i] = len(df_new.values)
-        
-    return acceptances
+        shape = tuple(2*len(edges)+1 for edges in self.edges)
+        if np.prod(shape, dtype=np.float64) > self.max_cells:
+            raise ValueError('%d cells in the cut histogram, use fewer bins' % np.prod(shape, dtype=np.float64))
+        cells = np.ravel_multi_index([index[valid] for index in indices], shape)
+        self.counts = np.bincount(cells, minlength=int(np.prod(shape))).reshape(shape)
+        
+        # cumulative[j0, j1, ...]: events with bin index < j along every axis
+        cumulative = np.pad(self.counts, [(1, 0)]*len(shape), mode='constant')
+        for axis in range(len(shape)):
+            cumulative = np.cumsum(cumulative, axis=axis)
+        self.cumulative = cumulative
+        
+        keys = [bound[0] for bound in self.cuts.bounds]
+        self.names = [key if keys.count(key) == 1 else '%s%d' %(key, i) for i, key in enumerate(keys)]
+        
+    def n_passing(self, lo, hi):
+        # events with lo[i] <= bin index < hi[i] for every cut i, lo / hi
+        # being equal length index arrays per cut
+        lo = [np.asarray(l) for l in lo]
+        hi = [np.maximum(np.asarray(h), l) for h, l in zip(hi, lo)]
+        n = 0
+        for corner in range(2**len(lo)):
+            index = tuple(hi[i] if corner >> i & 1 else lo[i] for i in range(len(lo)))
+            sign = (-1)**(len(lo) - bin(corner).count('1'))
+            n = n + sign*self.cumulative[index]
+        return n
+    
+    def candidates(self, n_candidates=10):
+        # bounds that are scanned (those not 'none') and their candidate edge indices
+        scanned = []
+        for i, (key, cut_min, cut_max) in enumerate(self.cuts.bounds):
+            edges = np.unique(np.linspace(0, len(self.edges[i])-1, n_candidates).round().astype(np.int64))
+            if cut_min is not None:
+                scanned.append((i, 'min', edges))
+            if cut_max is not None:
+                scanned.append((i, 'max', edges))
+        return scanned
+    
+    def scan(self, fom=None, n_candidates=10):
+        
+        # Every combination of n_candidates edges per scanned bound, as a
+        # DataFrame with the threshold values, the passing events, the
+        # acceptance and fom(table) sorted best first. fom gets the table
+        # (threshold columns <name>_min / <name>_max and acceptance) and
+        # returns one value per row, e.g. acceptance times a stability
+        # score of the LY fit; the acceptance itself by default.
+        scanned = self.candidates(n_candidates)
+        grid = np.meshgrid(*[edges for _, _, edges in scanned], indexing='ij')
+        grid = [g.ravel() for g in grid]
+        n_combinations = len(grid[0]) if grid else 1
+        
+        lo = [np.zeros(n_combinations, dtype=np.int64) for _ in self.edges]
+        hi = [np.full(n_combinations, 2*len(edges)+1, dtype=np.int64) for edges in self.edges]
+        columns = []
+        for (i, side, _), edge in zip(scanned, grid):
+            # value >= edges[k] <=> index >= 2k+1, value <= edges[k] <=> index < 2k+2
+            if side == 'min':
+                lo[i] = 2*edge + 1
+            else:
+                hi[i] = 2*edge + 2
+            columns.append(('%s_%s' %(self.names[i], side), self.edges[i][edge]))
+        
+        n = self.n_passing(lo, hi)
+        table = pd.DataFrame(dict(columns), columns=[name for name, _ in columns])
+        table['n_passing'] = n
+        table['acceptance'] = n/float(self.n_events) if self.n_events else 0.0
+        table['fom'] = table['acceptance'] if fom is None else fom(table)
+        return table.sort_values('fom', ascending=False, kind='mergesort').reset_index(drop=True)
+    
+    def cut_list(self, row):
+        # the cut lists with the thresholds of a scan row filled in
+        cuts = []
+        for i, cut in enumerate(self.cuts):
+            cut = list(cut)
+            for side, position in (('min', 1), ('max', 2)):
+                name = '%s_%s' %(self.names[i], side)
+                if name in row:
+                    cut[position] = float(row[name])
+            cuts.append(cut)
+        return cuts
+    
+    def check(self, df, row):
+        # the cut lists of a scan row applied to df select n_passing events
+        n = len(apply_cuts(df, self.cut_list(row)))
+        if n != row['n_passing']:
+            raise ValueError('scan row selects %d events, apply_cuts %d' %(row['n_passing'], n))
+        return True
+    
+    def optimize(self, fom=None, n_candidates=10):
+        # best cut lists and the full scan table
+        table = self.scan(fom, n_candidates)
+        return self.cut_list(table.iloc[0]), table
+
+def n1_cuts(df,cuts):
+    
+    # events passing all cuts but cut i, the last entry all cuts
+    return compile_cuts(cuts).cut_flow(df).n1().astype(np.float64)
@@ -0,0 +1,103 @@
+import weakref
+
+import numpy as np
+
+# Registry of quantities derived from the minitree columns (s1sRatio, s1Dt,
+# r, r^2, phi, drift time, S2/S1 ratios). column(df, name) returns a real
+# column of df as is; a registered derived quantity is computed vectorized on
+# first access and memoized for that table. A memoized value is recomputed
+# when one of its input columns is replaced (df[key] = ...), but not after an
+# input is edited in place (df.loc[...] = ...): call invalidate(df) then.
+# (Checking the content on every access would cost as much as recomputing.)
+#
+#   cuts = [['s1sRatio', 0.1, 1.0, 50, 0, 1.2, 'PE/PE'], ['s1Dt', 500, 2000, 50, -1000, 5000, 'ns']]
+#   df_cut = apply_cuts(df, cuts)   # no need to add the columns first
+
+##################################################################################################
+
+DERIVED = dict()
+
+def register(name, inputs, function):
+    # function(*input_arrays) -> array, inputs may be derived themselves
+    DERIVED[name] = (list(inputs), function)
+
+def _ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return numerator/denominator
+
+def _phi(x, y):
+    # angle in [0, 2 pi), as lce_helpers_v2.atan
+    phi = np.arctan2(y, x)
+    return np.where(phi < 0, phi + 2*np.pi, phi)
+
+register('s1sRatio', ['s11Area', 's10Area'], _ratio)
+register('s2sRatio', ['s21Area', 's20Area'], _ratio)
+register('s1Dt', ['s11Time', 's10Time'], np.subtract)
+register('s2Dt', ['s21Time', 's20Time'], np.subtract)
+register('driftTime', ['s20Time', 's10Time'], np.subtract)
+register('s2s1Ratio0', ['s20Area', 's10Area'], _ratio)
+register('s2s1Ratio1', ['s21Area', 's11Area'], _ratio)
+register('cs2cs1Ratio0', ['cs20Area', 'cs10Area'], _ratio)
+register('cs2cs1Ratio1', ['cs21Area', 'cs11Area'], _ratio)
+
+# positions are i0x / i1x in Kr83m_Basic_v3 and s10x / s11x in Kr83m_Basic
+for prefix in ['i0', 'i1', 's10', 's11']:
+    register(prefix+'r2', [prefix+'x', prefix+'y'], lambda x, y: x**2 + y**2)
+    register(prefix+'r', [prefix+'r2'], np.sqrt)
+    register(prefix+'phi', [prefix+'x', prefix+'y'], _phi)
+
+##################################################################################################
+
+# id(df) -> (weak reference to df, dict(name -> (input tokens, values)))
+_memo = dict()
+
+def _token(values):
+    # identifies the array a column currently points to
+    return (values.__array_interface__['data'][0], values.shape, values.strides, values.dtype.str)
+
+def _table_memo(df):
+    key = id(df)
+    if key not in _memo:
+        try:
+            ref = weakref.ref(df, lambda ref, key=key: _memo.pop(key, None))
+        except TypeError:
+            return dict()
+        _memo[key] = (ref, dict())
+    return _memo[key][1]
+
+def is_available(df, name):
+    return name in df.columns or name in DERIVED
+
+def column(df, name):
+
+    # values of column name of df, computing (and memoizing) it if derived.
+    # The memo follows replaced input columns only: after editing an input
+    # in place (df.loc[0, 's11Area'] = 4.) call invalidate(df) first, or the
+    # value from before the edit is returned
+    if name in df.columns:
+        return df[name].values
+    if name not in DERIVED:
+        raise KeyError('%s is neither a column nor a registered derived quantity' % name)
+
+    inputs, function = DERIVED[name]
+    arrays = [column(df, key) for key in inputs]
+    tokens = [_token(values) for values in arrays]
+
+    memo = _table_memo(df)
+    if name in memo and memo[name][0] == tokens:
+        return memo[name][1]
+    values = np.asarray(function(*arrays))
+    memo[name] = (tokens, values)
+    return values
+
+def invalidate(df, name=None):
+    # drop the memoized quantities of df (only name if given)
+    memo = _table_memo(df)
+    if name is None:
+        memo.clear()
+    else:
+        memo.pop(name, None)
+
+def add_columns(df, names):
+    # df with the derived quantities in names added as real columns
+    return df.assign(**dict((name, column(df, name)) for name in names if name not in df.columns))
@@ -0,0 +1,167 @@
+# Declarative description of the Kr83m minitree columns. Each entry is
+# (column, role, attribute, transform): role is a peak role (s10, s11, s20,
+# s21 and the stray peaks s12, s13, ... / s22, s23, ...) or an interaction
+# role (i0, i1), attribute is read from that peak / interaction, and
+# transform(value, interaction) is applied to it.
+# The pax branches a tree maker needs are derived from the same list, so a
+# new column is exactly one new entry and can only ever add the branch of
+# the attribute it names.
+
+import time
+
+##################################################################################################
+
+KR_ROLES = ['s10', 's11', 's20', 's21']
+INTERACTION_ROLES = ['i0', 'i1']
+
+# interaction each kr peak role belongs to, used by the area corrections
+ROLE_INTERACTION = dict(s10='i0', s20='i0', s11='i1', s21='i1')
+
+# branches hax always reads (hax.config['basic_branches']), event level
+# branches the extraction needs on top of the peak attributes
+BASIC_PEAK_ATTRIBUTES = ['area']
+EVENT_BRANCHES = ['dataset_name']
+
+##################################################################################################
+
+def to_ns(value, interaction):
+    # peak edges are stored in samples of 10 ns
+    return value*10.0
+
+def s1_corrected(value, interaction):
+    return value*interaction.s1_area_correction
+
+def s2_corrected(value, interaction):
+    return value*interaction.s2_area_correction
+
+def stray_roles(signal, n_stray):
+    # s12, s13, ... for the extra S1s and s22, s23, ... for the extra S2s
+    return ['%s%d' %(signal, rank) for rank in range(2, n_stray+2)]
+
+def _peak_fields(role, edges=False, corrected=None):
+    fields = [(role+'Area', role, 'area', None)]
+    if corrected is not None:
+        fields.append(('c'+role+'Area', role, 'area', corrected))
+    fields += [(role+'Coin', role, 'n_contributing_channels', None),
+               (role+'Time', role, 'hit_time_mean', None)]
+    if edges:
+        fields += [(role+'LeftEdge', role, 'left', to_ns),
+                   (role+'RightEdge', role, 'right', to_ns)]
+    return fields
+
+def _position_fields(role, prefix):
+    return [(prefix+axis, role, axis, None) for axis in ['x', 'y', 'z']]
+
+##################################################################################################
+
+def basic_fields(n_stray=1):
+    fields = (_peak_fields('s10', corrected=s1_corrected) + _position_fields('i0', 's10')
+              + _peak_fields('s20', corrected=s2_corrected)
+              + _peak_fields('s11', corrected=s1_corrected) + _position_fields('i1', 's11')
+              + _peak_fields('s21'))
+    for role in stray_roles('s1', n_stray) + stray_roles('s2', n_stray):
+        fields += _peak_fields(role)
+    return fields
+
+BASIC_FIELDS = basic_fields()
+
+def v3_fields(n_stray=1):
+    fields = (_peak_fields('s10', edges=True, corrected=s1_corrected) + _position_fields('i0', 'i0')
+              + _peak_fields('s20', edges=True, corrected=s2_corrected)
+              + _peak_fields('s11', edges=True, corrected=s1_corrected) + _position_fields('i1', 'i1')
+              + _peak_fields('s21', edges=True))
+    for role in stray_roles('s1', n_stray) + stray_roles('s2', n_stray):
+        fields += _peak_fields(role)
+    return fields
+
+V3_FIELDS = v3_fields()
+
+##################################################################################################
+
+def dataset_number(dsetname):
+
+    # xe100_<date>_<time>_<part>.xed -> <date><time> as one number
+    if dsetname.endswith('.xed'):
+        filename = dsetname.split("/")[-1]
+        _, date, time, _ = filename.split('_')
+        return int(date) * 1e4 + int(time)
+    else:
+        # TODO: XENON1T support
+        return 0
+
+##################################################################################################
+
+def peak_attributes(fields):
+    # peak attributes read by fields, in order of first use
+    attributes = []
+    for _, role, attribute, _ in fields:
+        if role not in INTERACTION_ROLES and attribute not in attributes:
+            attributes.append(attribute)
+    return attributes
+
+def required_branches(fields):
+    # extra_branches for a tree maker extracting fields
+    return EVENT_BRANCHES + ['peaks.'+attribute for attribute in peak_attributes(fields)
+                             if attribute not in BASIC_PEAK_ATTRIBUTES]
+
+def field_columns(fields):
+    return [column for column, _, _, _ in fields]
+
+##################################################################################################
+
+def extract_fields(fields, peaks, peak_roles, interaction_roles, access_seconds=None):
+
+    # peak_roles maps role -> peak index (-1 if the event has no such peak),
+    # interaction_roles maps role -> interaction; missing peaks give 0.
+    # If access_seconds is given, the time spent accessing each attribute
+    # (keyed by its branch name) is added to it.
+    event_data = dict()
+    for column, role, attribute, transform in fields:
+        if access_seconds is not None:
+            start = time.perf_counter()
+        if role in INTERACTION_ROLES:
+            value = getattr(interaction_roles[role], attribute)
+            branch = 'interactions.'+attribute
+        elif peak_roles[role] == -1:
+            event_data[column] = 0
+            continue
+        else:
+            value = getattr(peaks[peak_roles[role]], attribute)
+            branch = 'peaks.'+attribute
+        if access_seconds is not None:
+            access_seconds[branch] += time.perf_counter() - start
+        if transform is not None:
+            value = transform(value, interaction_roles.get(ROLE_INTERACTION.get(role)))
+        event_data[column] = value
+    return event_data
+
+##################################################################################################
+
+def assign_peak_roles(n_peaks, s1s, s2s, kr_peaks, n_stray=1):
+
+    # Label every peak of an event in one pass. kr_peaks maps s10/s11/s20/s21
+    # to peak indices (-1 if absent); the first n_stray S1s (S2s) in s1s (s2s),
+    # which pax sorts by area, that are not one of the kr S1s (S2s) become the
+    # stray roles s12, s13, ... (s22, s23, ...). Returns the per-peak labels
+    # ('' for unassigned peaks) and the role -> peak index mapping.
+    labels = [''] * n_peaks
+    roles = dict(kr_peaks)
+    for role, peak in kr_peaks.items():
+        if peak != -1:
+            labels[peak] = role
+
+    for signal, candidates in (('s1', s1s), ('s2', s2s)):
+        taken = (kr_peaks.get(signal+'0', -1), kr_peaks.get(signal+'1', -1))
+        names = stray_roles(signal, n_stray)
+        rank = 0
+        for peak in candidates:
+            if rank == n_stray:
+                break
+            if peak not in taken:
+                labels[peak] = names[rank]
+                roles[names[rank]] = peak
+                rank += 1
+        for name in names[rank:]:
+            roles[name] = -1
+
+    return labels, roles
@@ -0,0 +1,214 @@
+import sys
+
+import numpy as np
+
+from lazy_helpers import ROOT
+
+# Gaussian fits of many spectra at once, without ROOT. Every row of a
+# (bins x spectrum bins) count matrix is fit the way hist.Sumw2();
+# hist.Fit('gaus') fits a TH1D: least squares of amp*exp(-(x-mean)^2/(2 sigma^2))
+# at the bin centres, weighted by the sqrt(N) bin errors, skipping empty bins.
+# Starting values come from the moments of each row, then all rows take
+# Levenberg-Marquardt steps together (one batched 3x3 solve per iteration).
+#
+#   python fit_helpers.py 500
+#
+# fits 500 synthetic spectra with both fit_gaussians and ROOT and fails if
+# they disagree (needs PyROOT).
+
+##################################################################################################
+
+def spectra_matrix(values, bin_ids, n_bins, n_spec_bins, x_min, x_max):
+
+    # counts[b, k]: values of the events of bin_ids b in spectrum bin k (the
+    # in-range bins of TH1D('', '', n_spec_bins, x_min, x_max), events
+    # outside the range or with bin id -1 are dropped), filled in one pass
+    values = np.asarray(values, dtype=np.float64)
+    bin_ids = np.asarray(bin_ids)
+    inside = (bin_ids >= 0) & (values >= x_min) & (values < x_max)
+    # TAxis::FindBin, values rounding up to x_max go to the overflow as in ROOT
+    spec = (n_spec_bins*(values[inside]-x_min)/(x_max-x_min)).astype(np.int64)
+    ok = spec < n_spec_bins
+    counts = np.bincount(bin_ids[inside][ok]*n_spec_bins + spec[ok], minlength=n_bins*n_spec_bins)
+    return counts.reshape(n_bins, n_spec_bins).astype(np.float64)
+
+def bin_centers(n_spec_bins, x_min, x_max):
+    width = (x_max - x_min)/float(n_spec_bins)
+    return x_min + (np.arange(n_spec_bins) + 0.5)*width
+
+##################################################################################################
+
+def _gaus(params, x):
+    amp, mean, sigma = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    t = (x - mean)/sigma
+    g = np.exp(-0.5*t*t)
+    return amp*g, g, t
+
+def _chi2(params, x, counts, weights):
+    f = _gaus(params, x)[0]
+    return (weights*(counts - f)**2).sum(axis=1)
+
+def _normal_equations(params, x, counts, weights):
+    # J^T W J and J^T W (y - f) for every row
+    f, g, t = _gaus(params, x)
+    amp, sigma = params[:, 0:1], params[:, 2:3]
+    jac = np.stack([g, amp*g*t/sigma, amp*g*t*t/sigma], axis=2)
+    wj = weights[:, :, None]*jac
+    jtj = np.einsum('bki,bkj->bij', wj, jac)
+    jtr = np.einsum('bki,bk->bi', wj, counts - f)
+    return jtj, jtr
+
+def moment_guess(counts, x):
+
+    # amplitude from the highest bin, mean and sigma from the row moments
+    total = counts.sum(axis=1)
+    safe = np.where(total > 0, total, 1.0)
+    mean = (counts*x).sum(axis=1)/safe
+    sigma = np.sqrt(np.maximum((counts*(x - mean[:, None])**2).sum(axis=1)/safe, 0))
+    # a single filled bin still needs a finite width
+    sigma = np.maximum(sigma, (x[1] - x[0]) if len(x) > 1 else 1.0)
+    return np.stack([counts.max(axis=1), mean, sigma], axis=1)
+
+def fit_gaussians(counts, x_min, x_max, max_iter=200, tolerance=1e-10):
+
+    # Fit every row of counts (bins x spectrum bins over [x_min, x_max)).
+    # Returns a dict of per-row arrays: amplitude, mean, sigma, their errors
+    # (sqrt of the covariance diagonal, as ROOT reports for chi2 fits), chi2,
+    # ndf, chi2_ndf and converged (False also for fits that ran into the
+    # histogram range). Rows with fewer than 3 filled bins are not
+    # fit and get NaN parameters and ndf <= 0.
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    n_rows, n_spec_bins = counts.shape
+    x = bin_centers(n_spec_bins, x_min, x_max)
+
+    filled = counts > 0
+    weights = np.where(filled, 1.0/np.where(filled, counts, 1.0), 0.0)
+    n_points = filled.sum(axis=1)
+    fit = n_points >= 3
+
+    params = moment_guess(counts, x)
+    chi2 = _chi2(params, x, counts, weights)
+    lam = np.full(n_rows, 1e-3)
+    active = fit.copy()
+
+    for iteration in range(max_iter):
+        if not active.any():
+            break
+        rows = np.flatnonzero(active)
+        jtj, jtr = _normal_equations(params[rows], x, counts[rows], weights[rows])
+        diag = np.einsum('bii->bi', jtj)
+        damped = jtj + lam[rows, None, None]*np.einsum('bi,ij->bij', diag, np.eye(3))
+        try:
+            step = np.linalg.solve(damped, jtr[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(damped, jtr)])
+
+        trial = params[rows] + step
+        trial[:, 2] = np.abs(trial[:, 2])
+        trial_chi2 = _chi2(trial, x, counts[rows], weights[rows])
+        # sparse spectra can lower chi2 further with a flat, ever wider
+        # gaussian; steps leaving the histogram range are refused, which
+        # keeps the fit at the peak as Migrad does
+        inside = (trial[:, 1] >= x_min) & (trial[:, 1] <= x_max) & (trial[:, 2] <= x_max - x_min)
+        better = np.isfinite(trial_chi2) & (trial_chi2 <= chi2[rows]) & inside
+
+        improved = rows[better]
+        change = chi2[improved] - trial_chi2[better]
+        params[improved] = trial[better]
+        chi2[improved] = trial_chi2[better]
+        lam[improved] = np.maximum(lam[improved]/10.0, 1e-12)
+        lam[rows[~better]] *= 10.0
+
+        # converged once a step no longer changes chi2 (relatively), or
+        # the damping has grown so large that no step can be taken
+        done = np.zeros(len(rows), dtype=bool)
+        done[better] = change <= tolerance*np.maximum(chi2[improved], 1.0)
+        done |= lam[rows] > 1e12
+        active[rows[done]] = False
+
+    # a fit that ran into the range limits has no minimum inside them
+    at_limit = (params[:, 2] >= 0.99*(x_max - x_min)) | (params[:, 1] <= x_min) | (params[:, 1] >= x_max)
+    converged = fit & ~active & ~at_limit
+
+    # covariance from J^T W J at the minimum
+    errors = np.full((n_rows, 3), np.nan)
+    rows = np.flatnonzero(fit)
+    if len(rows):
+        jtj = _normal_equations(params[rows], x, counts[rows], weights[rows])[0]
+        invertible = np.abs(np.linalg.det(jtj)) > 0
+        cov = np.full_like(jtj, np.nan)
+        cov[invertible] = np.linalg.inv(jtj[invertible])
+        errors[rows] = np.sqrt(np.abs(np.einsum('bii->bi', cov)))
+
+    params[~fit] = np.nan
+    chi2[~fit] = np.nan
+    ndf = n_points - 3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2_ndf = np.where(ndf > 0, chi2/ndf, np.nan)
+
+    return dict(amplitude=params[:, 0], mean=params[:, 1], sigma=params[:, 2],
+                amplitude_error=errors[:, 0], mean_error=errors[:, 1], sigma_error=errors[:, 2],
+                chi2=chi2, ndf=ndf, chi2_ndf=chi2_ndf, converged=converged)
+
+##################################################################################################
+
+def root_fits(counts, x_min, x_max):
+
+    # the same rows fit by ROOT as lce_helpers_v2._fit_bin does it (TH1D with
+    # sqrt(N) errors, Fit('gaus')), NaN for rows with fewer than 3 filled bins
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    n_rows, n_spec_bins = counts.shape
+    keys = ['amplitude', 'mean', 'sigma']
+    fits = dict((key, np.full(n_rows, np.nan)) for key in keys + [key+'_error' for key in keys])
+    for i, row in enumerate(counts):
+        if (row > 0).sum() < 3:
+            continue
+        hist = ROOT.TH1D('', '', n_spec_bins, x_min, x_max)
+        for k, value in enumerate(row):
+            hist.SetBinContent(k+1, value)
+            hist.SetBinError(k+1, np.sqrt(value))
+        hist.SetEntries(row.sum())
+        hist.Fit('gaus', 'Q0')
+        fit = hist.GetFunction('gaus')
+        for j, key in enumerate(keys):
+            fits[key][i] = fit.GetParameter(j)
+            fits[key+'_error'][i] = fit.GetParError(j)
+        hist.Delete()
+    return fits
+
+def compare_root_fits(counts, x_min, x_max):
+
+    # largest relative difference between fit_gaussians and root_fits per
+    # quantity, over the rows both of them fit
+    ours = fit_gaussians(counts, x_min, x_max)
+    theirs = root_fits(counts, x_min, x_max)
+    rows = ours['converged'] & np.isfinite(theirs['mean'])
+    differences = dict()
+    for key in sorted(theirs):
+        scale = np.abs(theirs[key][rows])
+        differences[key] = np.max(np.abs(ours[key][rows] - theirs[key][rows])/scale) if rows.any() else 0.
+    return differences, rows.sum()
+
+def synthetic_spectra(n_rows, n_spec_bins=100, x_max=20000., seed=0):
+
+    # peaks like the s10 line, 20 to 2000 events per row
+    random = np.random.RandomState(seed)
+    n_events = random.randint(20, 2000, n_rows)
+    means = random.uniform(0.3, 0.7, n_rows)*x_max
+    sigmas = random.uniform(0.03, 0.1, n_rows)*x_max
+    values = np.concatenate([random.normal(m, s, n) for m, s, n in zip(means, sigmas, n_events)])
+    ids = np.repeat(np.arange(n_rows), n_events)
+    return spectra_matrix(values, ids, n_rows, n_spec_bins, 0, x_max)
+
+##################################################################################################
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    ROOT.gROOT.SetBatch(True)
+    differences, n_compared = compare_root_fits(synthetic_spectra(n_rows), 0, 20000.)
+    # parameters have to agree to Migrad's precision, errors a bit looser
+    limits = dict((key, 1e-2 if key.endswith('_error') else 1e-3) for key in differences)
+    print('%d of %d spectra compared' %(n_compared, n_rows))
+    for key in sorted(differences):
+        print('%-16s max rel. difference %.2e (limit %.0e)' %(key, differences[key], limits[key]))
+    sys.exit(0 if all(differences[key] <= limits[key] for key in differences) else 1)
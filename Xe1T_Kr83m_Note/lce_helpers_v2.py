@@ -1,21 +1,171 @@
 import numpy as np
 from collections import defaultdict
-import ROOT
+from lazy_helpers import ROOT, pd
 from subprocess import call
-import pandas as pd
+from multiprocessing import Pool, cpu_count
+
+from derived_helpers import column
+from cut_helpers import fill_hist
+from fit_helpers import spectra_matrix, fit_gaussians
 
 ##################################################################################################
 
 def atan(y, x):
     phi = np.arctan2(y, x)
-    for i in range(len(phi)):
-        if phi[i] < 0: 
-            phi[i] += 2*np.pi
-    return phi
+    return np.where(phi < 0, phi + 2*np.pi, phi)
 
 ##################################################################################################
 
-def xe_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
+def cylinder_bins(z, r, phi, bin_settings):
+    
+    # Flat bin id of every event for the (z, r, phi) bins of the lyBins loop,
+    # numbered in loop order (z_i, then r_i, then phi_i), -1 for events in no
+    # bin. Edges and open / closed sides are those of the loop:
+    # z_max <= z < z_min (z_width is negative), r_min < r <= r_max and
+    # phi_min < phi <= phi_max. Returns the ids and the number of bins.
+    R, Z, A_r, N_phi, N_z = bin_settings
+    z_width = Z / N_z
+    
+    z_edges = np.arange(int(N_z)+1) * z_width
+    if z_width < 0:
+        z_bin = np.searchsorted(-z_edges, -z, side='left') - 1
+    else:
+        # z_min < z_max, no event passes z < z_min and z >= z_max
+        z_bin = np.full(len(z), -1, dtype=np.int64)
+    z_bin[(z_bin < 0) | (z_bin >= int(N_z))] = -1
+    
+    r_edges = np.concatenate([[0], A_r])
+    r_bin = np.searchsorted(r_edges, r, side='left') - 1
+    r_bin[r_bin >= len(A_r)] = -1
+    
+    ring_offsets = np.concatenate([[0], np.cumsum(N_phi)]).astype(np.int64)
+    n_per_z = ring_offsets[-1]
+    
+    flat = np.full(len(z), -1, dtype=np.int64)
+    for r_i in range(len(A_r)):
+        ring = np.flatnonzero((r_bin == r_i) & (z_bin >= 0))
+        phi_edges = np.arange(N_phi[r_i]+1) * (2*np.pi/N_phi[r_i])
+        phi_bin = np.searchsorted(phi_edges, phi[ring], side='left') - 1
+        ok = (phi_bin >= 0) & (phi_bin < N_phi[r_i])
+        flat[ring[ok]] = z_bin[ring[ok]]*n_per_z + ring_offsets[r_i] + phi_bin[ok]
+    
+    return flat, int(N_z)*n_per_z
+
+def group_bins(flat, n_bins):
+    
+    # rows of the events of bin b are order[starts[b]:starts[b+1]], in
+    # table order (one stable sort for all bins)
+    valid = np.flatnonzero(flat >= 0)
+    order = valid[np.argsort(flat[valid], kind='mergesort')]
+    starts = np.concatenate([[0], np.cumsum(np.bincount(flat[valid], minlength=n_bins))])
+    return order, starts
+
+##################################################################################################
+
+# spectrum range (pe), line energy (keV, from nuclear data sheets a=83) and
+# position prefix per peak; only ever consider position of 1st s1
+LY_PEAKS = dict(s10=(20000, 32.1498, 'i0'),
+                s11=(100, 9.4051, 'i0'))
+
+def _fit_bin(areas, peak, s1_spec_max, bin_spec_dir, limits, indices):
+    
+    # ROOT gaus fit of the spectrum of one bin, (mean, error) or None if the
+    # bin is empty; limits are (z_min, z_max, r_min, r_max, phi_min, phi_max)
+    # for the title and indices (z_i, r_i, phi_i) for the figure name
+    c1 = ROOT.TCanvas('','', 800, 700)
+    hist = ROOT.TH1D('','', 100, 0, s1_spec_max)
+    fill_hist(hist, areas)
+        
+    if hist.GetEntries() < 1:
+        return None
+        
+    hist.SetTitle(peak+' Spectrum: \
+                  %.1f > z > %.1f, %.1f < r < %.1f, %.1f < phi < %.1f,'
+                  % limits)
+    hist.GetXaxis().SetTitle(peak+'Area (pe)')
+    hist.GetXaxis().CenterTitle()
+    hist.Sumw2()
+    hist.SetStats(False)
+    hist.Draw()
+    hist.Fit('gaus')
+    fit = hist.GetFunction('gaus')
+    p1 = fit.GetParameter(1)
+    e1 = fit.GetParError(1)
+    
+    if bin_spec_dir != 'none':
+        
+        call('mkdir '+bin_spec_dir,shell=True)
+    
+        chi2 = fit.GetChisquare()
+        ndf = fit.GetNDF()
+        p0 = fit.GetParameter(0)
+        e0 = fit.GetParError(0)
+        p2 = fit.GetParameter(2)
+        e2 = fit.GetParError(2)
+
+        pt = ROOT.TPaveText(.58, .68, .88, .88, 'NDC')
+        pt.AddText('Entries = %d'%len(areas))
+        pt.AddText('#mu = %1.3f #pm %1.3f'%(p1, e1))
+        pt.AddText('#sigma = %1.3f #pm %1.3f' %(p2, e2))
+        pt.AddText('Amplitude = %1.3f #pm %1.3f' %(p0, e0))
+        pt.AddText('#chi^{2}/NDF = %1.3f/%1.3f' %(chi2, ndf))
+
+        pt.Draw()
+
+        c1.Print(bin_spec_dir+'/f_'+peak+'_z%d_r%d_phi%d.png' % indices)
+    
+    c1.Clear()
+    hist.Delete()
+    return p1, e1
+
+def _append_fit(bin_data, result, s1_ene):
+    if result is None:
+        bin_data['ly'].append(-1)
+        bin_data['errly'].append(-1)
+        
+        bin_data['S1AreaMean'].append(-1)
+        bin_data['S1AreaMeanError'].append(-1)
+        return
+    p1, e1 = result
+    bin_data['S1AreaMean'].append(p1)
+    bin_data['S1AreaMeanError'].append(e1)
+    
+    bin_data['ly'].append(p1/s1_ene)
+    bin_data['errly'].append(e1/s1_ene)
+
+def _init_fit_worker():
+    # every worker has its own ROOT, without graphics
+    ROOT.gROOT.SetBatch(True)
+
+def _fit_bin_task(args):
+    peak, s1_spec_max, bin_spec_dir, bins = args
+    return [_fit_bin(areas, peak, s1_spec_max, bin_spec_dir, limits, indices)
+            for areas, limits, indices in bins]
+
+def _fit_bins_parallel(bins, peak, s1_spec_max, bin_spec_dir, n_workers):
+    
+    # bins split into ~4 tasks per worker, results back in the order of bins
+    n_tasks = min(len(bins), 4*n_workers)
+    bounds = np.linspace(0, len(bins), n_tasks+1).astype(int)
+    tasks = [(peak, s1_spec_max, bin_spec_dir, bins[start:stop])
+             for start, stop in zip(bounds[:-1], bounds[1:])]
+    
+    pool = Pool(n_workers, initializer=_init_fit_worker)
+    try:
+        results = pool.map(_fit_bin_task, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return [result for task in results for result in task]
+
+def xe_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists',n_workers=1):
+    
+    # n_workers > 1 fits the bins in that many worker processes (None: one
+    # per cpu), each bin sent as the array of its areas; bin_data comes back
+    # in the same order
+    if n_workers is None:
+        n_workers = cpu_count()
+    serial = n_workers <= 1
     
     R, Z, A_r, N_phi, N_z = bin_settings
     z_width = Z / N_z
@@ -23,26 +173,27 @@ def xe_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
     for n in N_phi:
         phi_widths.append(2*np.pi/n)
     
-    if peak == 's10':
-        s1_spec_max = 20000
-        s1_ene = 32.1498 # from nuclear data sheets a=83
-        position = 'i0'
-    elif peak == 's11':
-        s1_spec_max = 100
-        s1_ene = 9.4051
-        position = 'i0' # only ever consider position of 1st s1
-    else:
+    if peak not in LY_PEAKS:
         print('error: invalid peak')
         return()
+    s1_spec_max, s1_ene, position = LY_PEAKS[peak]
 
     bin_data = defaultdict(list)
+    
+    # every event's bin from one pass over the positions (taken from the
+    # derived column registry), and all bins' events from one sort
+    flat, n_bins = cylinder_bins(column(df, position+'z'), column(df, position+'r'),
+                                 column(df, position+'phi'), bin_settings)
+    order, starts = group_bins(flat, n_bins)
+    areas = column(df, peak+'Area')
+    b = 0
+    bins = []
 
 
     for z_i in range(int(N_z)):
     
         z_min = z_i * z_width
         z_max = (z_i+1) * z_width
-        df_z = df[ (df[position+'z']<z_min) & (df[position+'z']>=z_max) ]
     
         for r_i in range(len(A_r)):
         
@@ -51,8 +202,6 @@ def xe_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
             else:
                 r_min = A_r[r_i-1]
             r_max = A_r[r_i]
-            df_r = df_z[ ( np.sqrt(df_z[position+'x']**2 + df_z[position+'y']**2)>r_min )
-                       & ( np.sqrt(df_z[position+'x']**2 + df_z[position+'y']**2)<=r_max )]
         
             for phi_i in range(N_phi[r_i]):
             
@@ -66,73 +215,86 @@ def xe_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
                 phi_max = (phi_i+1) * phi_widths[r_i] 
                 bin_data['phi'].append( (phi_max + phi_min)/2 )
             
-                df_phi = df_r[ (atan(df_r[position+'y'].values, df_r[position+'x'].values) > phi_min) 
-                             & (atan(df_r[position+'y'].values, df_r[position+'x'].values) <= phi_max )]
+                rows = order[starts[b]:starts[b+1]]
+                b += 1
             
-                bin_data['N'].append(len(df_phi))
+                bin_data['N'].append(len(rows))
                 
-                c1 = ROOT.TCanvas('','', 800, 700)
-                hist = ROOT.TH1D('','', 100, 0, s1_spec_max)
-                for i in range(len(df_phi[peak+'Area'])):
-                    hist.Fill(df_phi[peak+'Area'].values[i])
-                    
-                if hist.GetEntries() < 1:
-                    bin_data['ly'].append(-1)
-                    bin_data['errly'].append(-1)
-                    
-                    bin_data['S1AreaMean'].append(-1)
-                    bin_data['S1AreaMeanError'].append(-1)
-                    
-                    continue
-                    
-                hist.SetTitle(peak+' Spectrum: \
-                              %.1f > z > %.1f, %.1f < r < %.1f, %.1f < phi < %.1f,'
-                              %(z_min, z_max, r_min, r_max, phi_min, phi_max))
-                hist.GetXaxis().SetTitle(peak+'Area (pe)')
-                hist.GetXaxis().CenterTitle()
-                hist.Sumw2()
-                hist.SetStats(False)
-                hist.Draw()
-                hist.Fit('gaus')
-                fit = hist.GetFunction('gaus')
-                p1 = fit.GetParameter(1)
-                e1 = fit.GetParError(1)
-                
-                bin_data['S1AreaMean'].append(p1)
-                bin_data['S1AreaMeanError'].append(e1)
-                
-                bin_data['ly'].append(p1/s1_ene)
-                bin_data['errly'].append(e1/s1_ene)
-                
-                if bin_spec_dir != 'none':
-                    
-                    call('mkdir '+bin_spec_dir,shell=True)
-                
-                    chi2 = fit.GetChisquare()
-                    ndf = fit.GetNDF()
-                    p0 = fit.GetParameter(0)
-                    e0 = fit.GetParError(0)
-                    p2 = fit.GetParameter(2)
-                    e2 = fit.GetParError(2)
-            
-                    pt = ROOT.TPaveText(.58, .68, .88, .88, 'NDC')
-                    pt.AddText('Entries = %d'%len(df_phi))
-                    pt.AddText('#mu = %1.3f #pm %1.3f'%(p1, e1))
-                    pt.AddText('#sigma = %1.3f #pm %1.3f' %(p2, e2))
-                    pt.AddText('Amplitude = %1.3f #pm %1.3f' %(p0, e0))
-                    pt.AddText('#chi^{2}/NDF = %1.3f/%1.3f' %(chi2, ndf))
-            
-                    pt.Draw()
-            
-                    c1.Print(bin_spec_dir+'/f_'+peak+'_z%d_r%d_phi%d.png' %(z_i, r_i, phi_i))
-                
-                c1.Clear()
-                hist.Delete()
+                fit_bin = (areas[rows], (z_min, z_max, r_min, r_max, phi_min, phi_max), (z_i, r_i, phi_i))
+                if serial:
+                    _append_fit(bin_data, _fit_bin(fit_bin[0], peak, s1_spec_max, bin_spec_dir,
+                                                   fit_bin[1], fit_bin[2]), s1_ene)
+                else:
+                    bins.append(fit_bin)
+    
+    if not serial:
+        for result in _fit_bins_parallel(bins, peak, s1_spec_max, bin_spec_dir, n_workers):
+            _append_fit(bin_data, result, s1_ene)
                 
     return bin_data
 
 ##################################################################################################
 
+def lyBins_geometry(bin_settings):
+    
+    # z_i, z, r_i, r, phi_i, phi of every bin, in the order of the xe_to_lyBins loop
+    R, Z, A_r, N_phi, N_z = bin_settings
+    z_width = Z / N_z
+    
+    bin_data = defaultdict(list)
+    for z_i in range(int(N_z)):
+        z_min = z_i * z_width
+        z_max = (z_i+1) * z_width
+        for r_i in range(len(A_r)):
+            r_min = 0 if r_i == 0 else A_r[r_i-1]
+            r_max = A_r[r_i]
+            phi_width = 2*np.pi/N_phi[r_i]
+            for phi_i in range(N_phi[r_i]):
+                phi_min = phi_i * phi_width
+                phi_max = (phi_i+1) * phi_width
+                bin_data['z_i'].append(z_i)
+                bin_data['z'].append( (z_max + z_min)/2 )
+                bin_data['r_i'].append(r_i)
+                bin_data['r'].append( (r_max + r_min)/2 )
+                bin_data['phi_i'].append(phi_i)
+                bin_data['phi'].append( (phi_max + phi_min)/2 )
+    return bin_data
+
+def xe_to_lyBins_batch(df,bin_settings,peak,n_spec_bins=100):
+    
+    # bin_data of xe_to_lyBins without ROOT and without the spectrum plots:
+    # the spectra of all bins go into one (bins x n_spec_bins) count matrix
+    # that fit_gaussians fits in one go (python fit_helpers.py checks it
+    # against ROOT). Empty bins get -1 as in xe_to_lyBins, and so do bins
+    # with fewer than 3 filled spectrum bins, which have no fit (ROOT fits
+    # them anyway), fits that did not converge or ran into the sigma / range
+    # limits, and any value a fit left undefined. S1AreaSigma,
+    # S1AreaAmplitude (with errors) and chi2_ndf are added per bin.
+    if peak not in LY_PEAKS:
+        print('error: invalid peak')
+        return()
+    s1_spec_max, s1_ene, position = LY_PEAKS[peak]
+    
+    flat, n_bins = cylinder_bins(column(df, position+'z'), column(df, position+'r'),
+                                 column(df, position+'phi'), bin_settings)
+    counts = spectra_matrix(column(df, peak+'Area'), flat, n_bins, n_spec_bins, 0, s1_spec_max)
+    fits = fit_gaussians(counts, 0, s1_spec_max)
+    n_events = np.bincount(flat[flat >= 0], minlength=n_bins)
+    unfit = (n_events < 1) | (fits['ndf'] < 0) | ~fits['converged']
+    
+    bin_data = lyBins_geometry(bin_settings)
+    bin_data['N'] = n_events.tolist()
+    for key, values in [('S1AreaMean', fits['mean']), ('S1AreaMeanError', fits['mean_error']),
+                        ('ly', fits['mean']/s1_ene), ('errly', fits['mean_error']/s1_ene),
+                        ('S1AreaSigma', fits['sigma']), ('S1AreaSigmaError', fits['sigma_error']),
+                        ('S1AreaAmplitude', fits['amplitude']),
+                        ('S1AreaAmplitudeError', fits['amplitude_error']),
+                        ('chi2_ndf', fits['chi2_ndf'])]:
+        bin_data[key] = np.where(unfit | ~np.isfinite(values), -1, values).tolist()
+    return bin_data
+
+##################################################################################################
+
 def lyBins_to_txt(bin_data,out_file):
     
     f = open(out_file, 'w')
@@ -0,0 +1,230 @@
+import os
+import time
+import hashlib
+from multiprocessing import Pool
+
+import pandas as pd
+import hax
+
+import stream_helpers
+import batch_helpers
+from telemetry_helpers import Telemetry
+from root_helpers import use_cache_for_hax
+
+##################################################################################################
+
+def _init_worker(hax_config):
+    # with the fork start method workers inherit the parent's hax config,
+    # otherwise it has to be passed in explicitly
+    if hax_config is not None:
+        hax.init(**hax_config)
+    use_cache_for_hax()
+
+def _load_dataset(args):
+
+    dataset, treemaker = args
+
+    start = time.time()
+    df = hax.minitrees.load([dataset], treemakers=treemaker)
+    seconds = time.time() - start
+
+    stats = dict(dataset=dataset,
+                 pid=os.getpid(),
+                 n_events=len(df),
+                 seconds=seconds,
+                 events_per_s=len(df)/seconds if seconds > 0 else 0.0)
+    return df, stats
+
+##################################################################################################
+
+def _run_pool(datasets, treemaker, n_workers=None, hax_config=None):
+
+    # One dataset per task, results come back in the order of datasets
+    # regardless of which worker finished first
+    tasks = [(dataset, treemaker) for dataset in datasets]
+
+    pool = Pool(n_workers, initializer=_init_worker, initargs=(hax_config,))
+    try:
+        results = pool.map(_load_dataset, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+def _worker_stats(results, verbose=True):
+
+    dataset_stats = pd.DataFrame([stats for _, stats in results])
+
+    worker_stats = dataset_stats.groupby('pid').agg(dict(dataset='count', n_events='sum', seconds='sum'))
+    worker_stats.columns = ['n_datasets', 'n_events', 'seconds']
+    worker_stats['events_per_s'] = worker_stats['n_events']/worker_stats['seconds']
+
+    if verbose:
+        for pid, row in worker_stats.iterrows():
+            print('worker %d: %d datasets, %d events in %.1f s (%.1f events/s)'
+                  %(pid, row['n_datasets'], row['n_events'], row['seconds'], row['events_per_s']))
+
+    return worker_stats
+
+def load_parallel(datasets, treemaker, n_workers=None, hax_config=None, verbose=True):
+
+    use_cache_for_hax()
+    results = _run_pool(datasets, treemaker, n_workers, hax_config)
+
+    data = pd.concat([df for df, _ in results], ignore_index=True)
+    worker_stats = _worker_stats(results, verbose)
+
+    return data, worker_stats
+
+##################################################################################################
+
+def treemaker_key(treemaker):
+
+    # Changes whenever the tree maker's version, branch list or number of
+    # stored stray peaks (which sets its columns) does
+    branches = ','.join(sorted(treemaker.extra_branches))
+    key = '%s;%s;%s' %(treemaker.__name__, treemaker.__version__, branches)
+    if getattr(treemaker, 'n_stray', 1) != 1:
+        key += ';n_stray=%d' % treemaker.n_stray
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+def _cache_file(cache_dir, dataset, treemaker):
+    return os.path.join(cache_dir, treemaker.__name__,
+                        '%s_%s.pkl' %(dataset, treemaker_key(treemaker)))
+
+def _drop_stale(cache_dir, dataset, treemaker):
+
+    # remove entries of this dataset written by other versions of the tree maker
+    current = os.path.basename(_cache_file(cache_dir, dataset, treemaker))
+    treemaker_dir = os.path.join(cache_dir, treemaker.__name__)
+    for name in os.listdir(treemaker_dir):
+        if name != current and name.endswith('.pkl') and name[:-4].rsplit('_', 1)[0] == dataset:
+            os.remove(os.path.join(treemaker_dir, name))
+
+def load_cached(datasets, treemaker, cache_dir='minitree_cache', n_workers=None,
+                hax_config=None, verbose=True):
+
+    # Only datasets without an entry for the current tree maker key are
+    # processed, everything else is read back from cache_dir
+    use_cache_for_hax()
+    treemaker_dir = os.path.join(cache_dir, treemaker.__name__)
+    if not os.path.isdir(treemaker_dir):
+        os.makedirs(treemaker_dir)
+
+    missing = [dataset for dataset in datasets
+               if not os.path.exists(_cache_file(cache_dir, dataset, treemaker))]
+
+    if verbose:
+        print('%s: %d/%d datasets cached, processing %d'
+              %(treemaker.__name__, len(datasets)-len(missing), len(datasets), len(missing)))
+
+    if missing:
+        results = _run_pool(missing, treemaker, n_workers, hax_config)
+        _worker_stats(results, verbose)
+
+        for dataset, (df, _) in zip(missing, results):
+            path = _cache_file(cache_dir, dataset, treemaker)
+            df.to_pickle(path+'.tmp')
+            os.replace(path+'.tmp', path)
+            _drop_stale(cache_dir, dataset, treemaker)
+
+    frames = [pd.read_pickle(_cache_file(cache_dir, dataset, treemaker)) for dataset in datasets]
+    return pd.concat(frames, ignore_index=True)
+
+##################################################################################################
+
+def stream_dataset(dataset, treemaker, out_dir, dtype=None, batch_size=100000):
+
+    # Extract a dataset straight into fixed-size .npy record batches instead
+    # of keeping one dict per event until the DataFrame is built
+    use_cache_for_hax()
+    tm = treemaker()
+    tm.telemetry = Telemetry(dataset, tm)
+    if dtype is None:
+        dtype = stream_helpers.treemaker_dtype(tm)
+    batcher = stream_helpers.RecordBatcher(dtype, stream_helpers.NpySink(out_dir, dataset), batch_size)
+
+    def process_event(event):
+        event_data = tm.extract_data(event)
+        if event_data:
+            batcher.append(event_data)
+
+    hax.paxroot.loop_over_dataset(dataset, process_event, branch_selection=tm.branch_selection)
+    batcher.flush()
+    tm.telemetry.write(getattr(tm, 'telemetry_dir', 'minitree_telemetry'))
+
+    return batcher.n_flushed
+
+def flat_file(flat_dir, dataset):
+    return os.path.join(flat_dir, dataset+'.npz')
+
+def load_batched(dataset, treemaker, chunk_size=10000, flat_dir=None):
+
+    # Batch extraction (treemaker.extract_flat, e.g. Kr83m_Basic_v3) of one
+    # dataset from hax's event loop. hax hands the callback the same reused
+    # event object every time, so events cannot be collected for
+    # extract_batch; instead each one is copied into an EventFlattener and
+    # the flattened chunk is extracted every chunk_size events. With
+    # flat_dir the flattened arrays are also saved there (see load_flat).
+    use_cache_for_hax()
+    tm = treemaker()
+    tm.telemetry = Telemetry(dataset, tm)
+    flattener = batch_helpers.EventFlattener()
+    frames = []
+    chunks = []
+
+    def extract_chunk():
+        flat = flattener.flat()
+        flattener.clear()
+        df = tm.extract_flat(flat)
+        # the rejection counters extract_data keeps per event
+        n_empty = int((flat['n_interactions'] == 0).sum())
+        tm.telemetry.reject_many('no_interactions', n_empty)
+        tm.telemetry.reject_many('no_second_s1', len(flat['n_peaks']) - n_empty - len(df))
+        frames.append(df)
+        if flat_dir is not None:
+            chunks.append(flat)
+
+    def process_event(event):
+        tm.telemetry.event()
+        flattener.add(event)
+        if len(flattener) == chunk_size:
+            extract_chunk()
+
+    hax.paxroot.loop_over_dataset(dataset, process_event, branch_selection=tm.branch_selection)
+    if len(flattener) or not frames:
+        extract_chunk()
+    tm.telemetry.write(getattr(tm, 'telemetry_dir', 'minitree_telemetry'))
+
+    if flat_dir is not None:
+        if not os.path.isdir(flat_dir):
+            os.makedirs(flat_dir)
+        batch_helpers.save_flat(flat_file(flat_dir, dataset), batch_helpers.concat_flat(chunks))
+
+    return pd.concat(frames, ignore_index=True)
+
+def load_flat(dataset, treemaker, flat_dir='flat_cache'):
+
+    # Flattened peak / interaction arrays of a dataset (batch_helpers.flatten_events
+    # layout), read with hax only if flat_dir has none yet. Everything that
+    # works on them, e.g. pairing_helpers.pair_events_df with another
+    # s1_window, is then a call on the saved arrays:
+    #
+    #   flat = load_flat('160807_1645', Kr83m_Basic_v3)
+    #   df = pairing_helpers.pair_events_df(flat, s1_window=(300, 2500))
+    flat = batch_helpers.load_flat(flat_file(flat_dir, dataset))
+    if flat is not None:
+        return flat
+
+    # treemaker only supplies the branch selection
+    use_cache_for_hax()
+    tm = treemaker()
+    flattener = batch_helpers.EventFlattener()
+    hax.paxroot.loop_over_dataset(dataset, flattener.add, branch_selection=tm.branch_selection)
+    flat = flattener.flat()
+
+    if not os.path.isdir(flat_dir):
+        os.makedirs(flat_dir)
+    batch_helpers.save_flat(flat_file(flat_dir, dataset), flat)
+    return flat
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+from batch_helpers import segment_offsets, gather_ranges, extract_fields_batch
+from field_helpers import V3_FIELDS, KR_ROLES, s1_corrected, s2_corrected, field_columns
+
+# Delayed coincidence pairing for the 32.1 / 9.4 keV Kr83m decays, working
+# directly on the flattened peak arrays of batch_helpers.flatten_events.
+# S1s and S2s of a chunk are sorted by (event, hit_time_mean) once; partners
+# are then found with binary searches, so a different s1Dt window only needs
+# a new call on the same arrays instead of a new pass with hax:
+# minitree_helpers.load_flat keeps them per dataset.
+
+##################################################################################################
+
+# peak columns that do not need an interaction (no positions / corrections)
+PAIR_FIELDS = [field for field in V3_FIELDS
+               if field[1] in KR_ROLES and field[3] not in (s1_corrected, s2_corrected)]
+
+##################################################################################################
+
+def _sorted_peaks(flat, signal):
+
+    # all S1s (S2s) of the chunk sorted by event, then by time
+    counts = flat['n_'+signal+'s']
+    owner = np.repeat(np.arange(len(counts)), counts)
+    local = flat[signal+'s']
+    peak = segment_offsets(flat['n_peaks'])[owner] + local
+    order = np.lexsort((flat['hit_time_mean'][peak], owner))
+    return dict(owner=owner[order], local=local[order],
+                time=flat['hit_time_mean'][peak][order], area=flat['area'][peak][order])
+
+def _best_in_window(q_owner, q_time, peaks, window, exclude=None):
+
+    # For every query (event, time) the index into peaks of the largest peak
+    # of the same event with time - q_time in [window[0], window[1]], -1 if none.
+    # Events are laid out on one axis by offsetting each by span, the search
+    # bounds are widened by 1 ns and the exact window applied afterwards.
+    dt_min, dt_max = window
+    n_q = len(q_owner)
+    best = np.full(n_q, -1, dtype=np.int64)
+    if n_q == 0 or len(peaks['time']) == 0:
+        return best
+
+    t0 = min(peaks['time'].min(), q_time.min())
+    t1 = max(peaks['time'].max(), q_time.max())
+    span = (t1 - t0) + max(abs(dt_min), abs(dt_max) if np.isfinite(dt_max) else 0) + 2
+    key = peaks['owner']*span + (peaks['time'] - t0)
+    q_key = q_owner*span + (q_time - t0)
+
+    lo = np.searchsorted(key, q_key + dt_min - 1, side='left')
+    if np.isfinite(dt_max):
+        hi = np.searchsorted(key, q_key + dt_max + 1, side='right')
+    else:
+        hi = np.searchsorted(key, (q_owner + 1)*span - 1, side='right')
+
+    query = np.repeat(np.arange(n_q), hi - lo)
+    cand = gather_ranges(lo, hi - lo)
+    dt = peaks['time'][cand] - q_time[query]
+    ok = (peaks['owner'][cand] == q_owner[query]) & (dt >= dt_min) & (dt <= dt_max)
+    if exclude is not None:
+        ok &= cand != exclude[query]
+    query = query[ok]
+    cand = cand[ok]
+
+    # largest area first within each query
+    order = np.lexsort((-peaks['area'][cand], query))
+    queries, first = np.unique(query[order], return_index=True)
+    best[queries] = cand[order][first]
+    return best
+
+##################################################################################################
+
+def pair_kr_peaks(flat, s1_window=(500, 2000), drift_window=(0, np.inf)):
+
+    # Returns s10/s11/s20/s21 as local peak indices per event (-1 if absent).
+    # s10 is the largest S1 that has a partner s11 delayed by s1_window (the
+    # largest such partner); s20 is the largest S2 in drift_window after s10
+    # and s21 the largest S2 delayed from s20 by s1_window.
+    n_events = len(flat['n_peaks'])
+    roles = dict((role, np.full(n_events, -1, dtype=np.int64)) for role in KR_ROLES)
+
+    s1 = _sorted_peaks(flat, 's1')
+    partner = _best_in_window(s1['owner'], s1['time'], s1, s1_window,
+                              exclude=np.arange(len(s1['time'])))
+
+    # largest first S1 with a partner in each event
+    paired = np.flatnonzero(partner >= 0)
+    order = np.lexsort((-s1['area'][paired], s1['owner'][paired]))
+    events, first = np.unique(s1['owner'][paired][order], return_index=True)
+    first_s1 = paired[order][first]
+    second_s1 = partner[first_s1]
+    roles['s10'][events] = s1['local'][first_s1]
+    roles['s11'][events] = s1['local'][second_s1]
+
+    s2 = _sorted_peaks(flat, 's2')
+    first_s2 = _best_in_window(events, s1['time'][first_s1], s2, drift_window)
+    has_s2 = first_s2 >= 0
+    roles['s20'][events[has_s2]] = s2['local'][first_s2[has_s2]]
+
+    second_s2 = _best_in_window(events[has_s2], s2['time'][first_s2[has_s2]], s2, s1_window,
+                                exclude=first_s2[has_s2])
+    has_s21 = second_s2 >= 0
+    roles['s21'][events[has_s2][has_s21]] = s2['local'][second_s2[has_s21]]
+
+    return roles
+
+def pair_events_df(flat, s1_window=(500, 2000), drift_window=(0, np.inf)):
+
+    # Peak columns of the paired events (those with s10, s11 and s20) plus s1Dt
+    roles = pair_kr_peaks(flat, s1_window, drift_window)
+    events = np.flatnonzero((roles['s10'] >= 0) & (roles['s20'] >= 0))
+    roles = dict((role, local[events]) for role, local in roles.items())
+
+    columns = dict(event_number=flat['event_number'][events],
+                   event_time=flat['event_time'][events],
+                   dataset_number=flat['dataset_number'][events])
+    columns.update(extract_fields_batch(PAIR_FIELDS, flat, segment_offsets(flat['n_peaks'])[events],
+                                        roles, dict()))
+    columns['s1Dt'] = columns['s11Time'] - columns['s10Time']
+
+    order = ['event_number', 'event_time', 'dataset_number'] + field_columns(PAIR_FIELDS) + ['s1Dt']
+    return pd.DataFrame(columns, columns=order)
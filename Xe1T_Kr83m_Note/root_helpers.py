@@ -0,0 +1,130 @@
+import os
+import sys
+import glob
+import shutil
+import fcntl
+import hashlib
+from multiprocessing import Process
+
+from lazy_helpers import ROOT
+
+# Build cache for ACLiC-compiled ROOT dictionaries (stl_loader.h, the
+# pax_event_class-<hash>.cpp files hax writes). Every macro is compiled once
+# per ROOT version into a shared cache directory, under a name carrying the
+# hash of its content; later kernels and worker processes just load the
+# shared library from there. use_cache_for_hax() makes hax load its event
+# classes the same way.
+#
+#   python root_helpers.py stl_loader.h pax_event_class-*.cpp
+#
+# compiles everything given into the cache ahead of time.
+
+##################################################################################################
+
+_loaded = dict()
+
+def cache_dir():
+    # $XERPI_ROOT_CACHE or ~/.cache/xerpi_root, one sub directory per ROOT version
+    base = os.environ.get('XERPI_ROOT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'xerpi_root'))
+    return os.path.join(base, 'root_' + ROOT.gROOT.GetVersion().replace('/', '_'))
+
+def _content_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+def _library_name(source):
+    # name ACLiC gives the library built from source: dir/foo.h -> dir/foo_h.so
+    base, ext = os.path.splitext(source)
+    return base + '_' + ext[1:] + '.' + ROOT.gSystem.GetSoExt()
+
+def _compile(filename, source):
+
+    # compile source (a copy of filename) in the cache directory itself, so
+    # the dictionary pcm refers to a header that stays there
+    shutil.copy(filename, source + '.tmp')
+    os.rename(source + '.tmp', source)
+    build_dir = ROOT.gSystem.GetBuildDir()
+    ROOT.gSystem.SetBuildDir(os.path.dirname(source), True)
+    try:
+        return ROOT.gROOT.LoadMacro(source + '+') == 0
+    finally:
+        ROOT.gSystem.SetBuildDir(build_dir)
+
+def _load_or_compile(filename, source, library):
+
+    # Every process takes the lock of source: shared to load an existing
+    # library, exclusive to build one, so nobody loads a library another
+    # process is still linking
+    with open(os.path.splitext(source)[0] + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            if os.path.exists(library):
+                return ROOT.gSystem.Load(library) >= 0
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # built by another process while we waited
+            if os.path.exists(library):
+                return ROOT.gSystem.Load(library) >= 0
+            return _compile(filename, source)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def load_macro_cached(filename):
+
+    # Equivalent of ROOT.gROOT.LoadMacro(filename+'+') that only compiles
+    # when the cache has no library for this content and ROOT version
+    key = _content_hash(filename)
+    if key in _loaded:
+        return _loaded[key]
+
+    directory = cache_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    source = os.path.join(directory, '%s-%s%s' %(stem, key, ext))
+    library = _library_name(source)
+
+    if not _load_or_compile(filename, source, library):
+        raise RuntimeError('could not load %s' % filename)
+
+    _loaded[key] = library
+    return library
+
+def use_cache_for_hax():
+
+    # Route hax's pax event class loading (hax.paxroot.load_event_class,
+    # called for every new pax_event_class file) through load_macro_cached,
+    # so each event class version is compiled once per ROOT version instead
+    # of once per kernel and worker. Call it before hax opens any file, in
+    # the kernel and in every worker process.
+    import hax.paxroot
+    if getattr(hax.paxroot.load_event_class, 'uses_cache', False):
+        return
+    def load_event_class(filename):
+        load_macro_cached(filename)
+    load_event_class.uses_cache = True
+    hax.paxroot.load_event_class = load_event_class
+
+def precompile(filenames):
+
+    # Fill the cache, each file in its own process: the pax_event_class
+    # versions define the same classes and cannot share one interpreter
+    for filename in filenames:
+        process = Process(target=load_macro_cached, args=(filename,))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError('could not compile %s' % filename)
+
+##################################################################################################
+
+if __name__ == '__main__':
+    filenames = []
+    for pattern in sys.argv[1:]:
+        filenames += sorted(glob.glob(pattern))
+    precompile(filenames)
+    print('%d files compiled into %s' %(len(filenames), cache_dir()))
@@ -0,0 +1,111 @@
+import os
+import glob
+
+import numpy as np
+import pandas as pd
+
+from field_helpers import field_columns
+
+# Fixed-size typed record batches for tree maker output. Events are written
+# into a preallocated structured array which is handed to a sink once it is
+# full, so memory stays at one batch no matter how long the run is.
+
+##################################################################################################
+
+INT_COLUMNS = ['event_number', 'event_time']
+
+EVENT_COLUMNS = ['event_number', 'event_time', 'dataset_number']
+
+def record_dtype(columns):
+    # coincidence levels of every peak role (s13Coin, ... with n_stray > 1) are integers too
+    return np.dtype([(key, np.int64 if key in INT_COLUMNS or key.endswith('Coin') else np.float64)
+                     for key in columns])
+
+def treemaker_dtype(tm):
+    # record layout of the event dicts tree maker instance tm extracts
+    return record_dtype(EVENT_COLUMNS + field_columns(tm.fields))
+
+##################################################################################################
+
+class RecordBatcher(object):
+
+    def __init__(self, dtype, sink, batch_size=100000):
+        self.dtype = np.dtype(dtype)
+        self.sink = sink
+        self.batch_size = batch_size
+        self.n_flushed = 0
+        self._new_batch()
+
+    def _new_batch(self):
+        self.batch = np.empty(self.batch_size, dtype=self.dtype)
+        self.n = 0
+
+    def append(self, event_data):
+        self.batch[self.n] = tuple(event_data[key] for key in self.dtype.names)
+        self.n += 1
+        if self.n == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.n == 0:
+            return
+        self.sink(self.batch[:self.n])
+        self.n_flushed += self.n
+        # the sink may hold on to the flushed batch, so start a fresh one
+        self._new_batch()
+
+##################################################################################################
+
+class NpySink(object):
+
+    # writes every batch to out_dir/<prefix>_<batch number>.npy
+    def __init__(self, out_dir, prefix):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        # batches of an earlier run would otherwise be loaded along with
+        # these whenever it wrote more of them
+        for f in _batch_files(out_dir, prefix):
+            os.remove(f)
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.n_batches = 0
+
+    def __call__(self, batch):
+        np.save(os.path.join(self.out_dir, '%s_%05d.npy' %(self.prefix, self.n_batches)), batch)
+        self.n_batches += 1
+
+def _batch_files(out_dir, prefix):
+    # only <prefix>_<5 digits>.npy, not the batches of a dataset named <prefix>_...
+    return sorted(glob.glob(os.path.join(glob.escape(out_dir), glob.escape(prefix)+'_'+'[0-9]'*5+'.npy')))
+
+def load_batches(out_dir, prefix, columns=None):
+
+    files = _batch_files(out_dir, prefix)
+    batches = [np.load(f, mmap_mode='r') for f in files]
+    if not batches:
+        return pd.DataFrame()
+    if columns is None:
+        columns = batches[0].dtype.names
+    return pd.DataFrame({key: np.concatenate([b[key] for b in batches]) for key in columns},
+                        columns=columns)
+
+##################################################################################################
+
+def iter_batches(events, treemaker, dtype=None, batch_size=100000):
+
+    # Generator version: yields one structured array per full batch, laid
+    # out as treemaker (an instance) extracts them unless dtype is given
+    if dtype is None:
+        dtype = treemaker_dtype(treemaker)
+    ready = []
+    batcher = RecordBatcher(dtype, ready.append, batch_size)
+    for event in events:
+        event_data = treemaker.extract_data(event)
+        if not event_data:
+            continue
+        batcher.append(event_data)
+        if ready:
+            yield ready.pop()
+    batcher.flush()
+    if ready:
+        yield ready.pop()
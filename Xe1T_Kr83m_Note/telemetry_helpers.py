@@ -0,0 +1,93 @@
+import os
+import json
+import time
+from collections import defaultdict
+
+# Counters for the Kr83m tree makers: events seen, events dropped per early
+# return reason, and the time spent accessing each attribute of the already
+# loaded pax objects (the branch I/O itself happens in hax's GetEntry and
+# is not included). Access times are only taken on every sample_every-th
+# event so the per-event cost stays at a couple of integer increments.
+
+##################################################################################################
+
+class Telemetry(object):
+
+    def __init__(self, dataset, treemaker, sample_every=100):
+        self.dataset = dataset
+        self.treemaker = type(treemaker).__name__
+        self.version = treemaker.__version__
+        self.sample_every = sample_every
+        self.n_events = 0
+        self.n_sampled = 0
+        self.rejected = defaultdict(int)
+        self.access_seconds = defaultdict(float)
+        self.start = time.time()
+
+    def event(self):
+        # call once per event, returns the dict to accumulate attribute access
+        # times into for sampled events and None otherwise
+        self.n_events += 1
+        if self.n_events % self.sample_every:
+            return None
+        self.n_sampled += 1
+        return self.access_seconds
+
+    def reject(self, reason):
+        self.rejected[reason] += 1
+
+    def reject_many(self, reason, n):
+        # for extraction paths that drop a whole chunk's events at once
+        if n:
+            self.rejected[reason] += n
+
+    def summary(self):
+        seconds = time.time() - self.start
+        n_sampled = max(self.n_sampled, 1)
+        return dict(dataset=self.dataset,
+                    treemaker=self.treemaker,
+                    version=self.version,
+                    n_events=self.n_events,
+                    n_extracted=self.n_events - sum(self.rejected.values()),
+                    rejected=dict(self.rejected),
+                    seconds=seconds,
+                    events_per_s=self.n_events/seconds if seconds > 0 else 0.0,
+                    n_sampled=self.n_sampled,
+                    attribute_access_us_per_event=dict((attribute, 1e6*t/n_sampled)
+                                                       for attribute, t in self.access_seconds.items()))
+
+    def write(self, out_dir):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        path = os.path.join(out_dir, '%s_%s.json' %(self.dataset, self.treemaker))
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+        return path
+
+##################################################################################################
+
+class TelemetryMixin(object):
+
+    # Put in front of hax.minitrees.TreeMaker in the bases: every get_data
+    # call (one dataset) gets a fresh Telemetry whose summary is written
+    # to telemetry_dir/<dataset>_<TreeMaker>.json
+    telemetry_dir = 'minitree_telemetry'
+
+    def __init__(self, *args, **kwargs):
+        super(TelemetryMixin, self).__init__(*args, **kwargs)
+        self.telemetry = Telemetry(None, self)
+
+    def get_data(self, dataset, *args, **kwargs):
+        self.telemetry = Telemetry(dataset, self)
+        try:
+            return super(TelemetryMixin, self).get_data(dataset, *args, **kwargs)
+        finally:
+            self.telemetry.write(self.telemetry_dir)
+
+def load_telemetry(out_dir):
+    summaries = []
+    for name in sorted(os.listdir(out_dir)):
+        if name.endswith('.json'):
+            with open(os.path.join(out_dir, name)) as f:
+                summaries.append(json.load(f))
+    return summaries
@@ -1,11 +1,28 @@
-import ROOT
+from lazy_helpers import ROOT, pd
 from collections import defaultdict
-import pandas as pd
+import numpy as np
+from multiprocessing import Pool
+import os
+import json
+import hashlib
 
+from root_helpers import load_macro_cached
 
-def load_xerawdp_tree(datasets,xerawdpPath):
+STL_LOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stl_loader.h')
+
+
+# branches read by build_xerawdp_df (spread over the T1/T2/T3 trees)
+XERAWDP_BRANCHES = ['NbS1Peaks', 'NbS2Peaks',
+                    'S1sTot', 'cS1sTot', 'S1sPeak', 'S1sCoin', 'S1sLeftEdge', 'S1sRightEdge',
+                    'S2sTot', 'cS2sTot', 'S2sPeak', 'S2sCoin', 'S2sLeftEdge', 'S2sRightEdge',
+                    'cS2sPosNn']
+
+# branches the Kr pre-selection looks at
+PRESELECTION_BRANCHES = ['NbS1Peaks', 'S1sTot', 'NbS2Peaks']
+
+def load_xerawdp_tree(datasets,xerawdpPath,branches=None):
     
-    ROOT.gROOT.LoadMacro("stl_loader.h+")
+    load_macro_cached(STL_LOADER)
     
     xerawdpTree = ROOT.TChain('T1')
     t2 = ROOT.TChain('T2')
@@ -19,13 +36,49 @@ def load_xerawdp_tree(datasets,xerawdpPath):
     xerawdpTree.AddFriend(t2)
     xerawdpTree.AddFriend(t3)
     
+    if branches is not None:
+        _enable_branches([xerawdpTree, t2, t3], branches)
+    
     return xerawdpTree
+
+def _enable_branches(trees, branches):
+    
+    # read only the given branches, wherever they live
+    for tree in trees:
+        tree.SetBranchStatus('*', 0)
+        for branch in branches:
+            if tree.GetBranch(branch):
+                tree.SetBranchStatus(branch, 1)
+
+def open_xerawdp_file(filename, branches=XERAWDP_BRANCHES):
+    
+    # T1 with T2 and T3 as friends, all taken from one open of the file
+    # instead of three chains indexing it separately. The TFile is returned
+    # too and has to be kept alive while the tree is used.
+    load_macro_cached(STL_LOADER)
+    
+    xerawdpFile = ROOT.TFile.Open(filename)
+    xerawdpTree = xerawdpFile.Get('T1')
+    t2 = xerawdpFile.Get('T2')
+    t3 = xerawdpFile.Get('T3')
     
-def build_xerawdp_df(xerawdpTree):
+    xerawdpTree.AddFriend(t2)
+    xerawdpTree.AddFriend(t3)
+    
+    if branches is not None:
+        _enable_branches([xerawdpTree, t2, t3], branches)
+    
+    return xerawdpFile, xerawdpTree
+    
+def build_xerawdp_df(xerawdpTree, entries=None):
 
+    # entries: entry numbers to visit (e.g. from load_entry_lists), all if None
+    if entries is None:
+        entries = range(xerawdpTree.GetEntries())
+    
     data = defaultdict(list)
 
-    for i in range(xerawdpTree.GetEntries()):
+    for i in entries:
         xerawdpTree.GetEntry(i)
         
         if xerawdpTree.NbS1Peaks < 2 or xerawdpTree.S1sTot[0] <= 0 or xerawdpTree.NbS2Peaks < 1:
@@ -82,3 +135,294 @@ def build_xerawdp_df(xerawdpTree):
     
     df_xerawdp = pd.DataFrame(data)
     return df_xerawdp
+
+
+def _jagged_head(column, n, width=1):
+    
+    # first n entries of every row of a jagged column (0 where a row is shorter)
+    # and the row lengths; width > 1 for rows of fixed-size vectors like positions
+    lengths = np.fromiter(map(len, column), dtype=np.int64, count=len(column))
+    flat = np.concatenate(column) if lengths.sum() else np.zeros(0)
+    if flat.dtype == object:
+        flat = np.array(list(flat), dtype=np.float64)
+    flat = flat.astype(np.float64).reshape(-1, width)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    
+    head = np.zeros((len(column), n, width))
+    for k in range(n):
+        has = lengths > k
+        head[has, k] = flat[offsets[has] + k]
+    return (head if width > 1 else head[:, :, 0]), lengths
+
+def _preselection(n_s1, s1_area, n_s2):
+    # entries build_xerawdp_df keeps (the inverse of its continue condition)
+    return (n_s1 >= 2) & (s1_area > 0) & (n_s2 >= 1)
+
+def _select_chunk(arrays):
+    
+    s1 = dict((key, _jagged_head(arrays[key], 2)[0]) for key in
+              ['S1sTot', 'cS1sTot', 'S1sPeak', 'S1sCoin', 'S1sLeftEdge', 'S1sRightEdge'])
+    keep = _preselection(arrays['NbS1Peaks'], s1['S1sTot'][:, 0], arrays['NbS2Peaks'])
+    
+    s1 = dict((key, values[keep]) for key, values in s1.items())
+    s2 = dict((key, _jagged_head(arrays[key][keep], 2)[0]) for key in
+              ['S2sTot', 'S2sPeak', 'S2sCoin', 'S2sLeftEdge', 'S2sRightEdge'])
+    s2['cS2sTot'], n_s2 = _jagged_head(arrays['cS2sTot'][keep], 2)
+    pos = _jagged_head(arrays['cS2sPosNn'][keep], 2, 3)[0]
+    
+    # events with a single s2 get the same defaults as build_xerawdp_df
+    double = n_s2 >= 2
+    
+    data = dict()
+    for i in range(2):
+        data['cs1%dArea'%i] = s1['cS1sTot'][:, i]
+        data['s1%dArea'%i] = s1['S1sTot'][:, i]
+        data['s1%dTime'%i] = s1['S1sPeak'][:, i]*10.0
+        data['s1%dCoin'%i] = s1['S1sCoin'][:, i]
+        data['s1%dLeftEdge'%i] = s1['S1sLeftEdge'][:, i]*10.0
+        data['s1%dRightEdge'%i] = s1['S1sRightEdge'][:, i]*10.0
+    for i in range(2):
+        use = double if i == 1 else np.ones(len(double), dtype=bool)
+        data['cs2%dArea'%i] = np.where(use, s2['cS2sTot'][:, i], 0.0)
+        data['s2%dArea'%i] = np.where(use, s2['S2sTot'][:, i], 0.0)
+        data['s2%dTime'%i] = np.where(use, s2['S2sPeak'][:, i]*10.0, 0.0)
+        data['s2%dCoin'%i] = np.where(use, s2['S2sCoin'][:, i], 0.0)
+        data['s2%dLeftEdge'%i] = np.where(use, s2['S2sLeftEdge'][:, i]*10.0, 0.0)
+        data['s2%dRightEdge'%i] = np.where(use, s2['S2sRightEdge'][:, i]*10.0, 0.0)
+        for j, axis in enumerate(['x', 'y', 'z']):
+            default = 35.0 if axis == 'z' else 15.0
+            data['i%d%s'%(i, axis)] = np.where(use, pos[:, i, j]/10.0, default)
+    return data, double
+
+XERAWDP_COLUMNS = ['cs10Area', 's10Area', 's10Time', 's10Coin', 's10LeftEdge', 's10RightEdge',
+                   'cs11Area', 's11Area', 's11Time', 's11Coin', 's11LeftEdge', 's11RightEdge',
+                   'cs20Area', 's20Area', 's20Time', 's20Coin', 's20LeftEdge', 's20RightEdge',
+                   'i0x', 'i0y', 'i0z',
+                   'cs21Area', 's21Area', 's21Time', 's21Coin', 's21LeftEdge', 's21RightEdge',
+                   'i1x', 'i1y', 'i1z']
+
+def read_xerawdp_arrays(xerawdpTree, chunk_size=100000):
+    
+    # Columns of build_xerawdp_df as numpy arrays. The branches are read as
+    # (jagged) arrays chunk_size entries at a time and the Kr selection and
+    # the single s2 defaults are applied to whole chunks
+    from root_numpy import tree2array
+    
+    chunks = []
+    all_double = True
+    n_entries = xerawdpTree.GetEntries()
+    for start in range(0, n_entries, chunk_size):
+        arrays = tree2array(xerawdpTree, branches=XERAWDP_BRANCHES,
+                            start=start, stop=min(start+chunk_size, n_entries))
+        data, double = _select_chunk(arrays)
+        all_double &= bool(double.all())
+        chunks.append(data)
+    
+    data = dict((key, np.concatenate([c[key] for c in chunks]) if chunks else np.zeros(0))
+                for key in XERAWDP_COLUMNS)
+    
+    # integer branches stay integer as long as no s2 default had to be filled in
+    for key in ['s10Coin', 's11Coin', 's20Coin'] + (['s21Coin'] if all_double else []):
+        data[key] = data[key].astype(np.int64)
+    return data
+
+def build_xerawdp_df_bulk(xerawdpTree, chunk_size=100000):
+    
+    # Same table as build_xerawdp_df without the per-entry loop
+    return pd.DataFrame(read_xerawdp_arrays(xerawdpTree, chunk_size), columns=XERAWDP_COLUMNS)
+
+def _read_dataset(args):
+    
+    dataset, xerawdpPath, chunk_size = args
+    xerawdpFile, xerawdpTree = open_xerawdp_file(xerawdpPath+dataset+'.root')
+    try:
+        return read_xerawdp_arrays(xerawdpTree, chunk_size)
+    finally:
+        xerawdpFile.Close()
+
+def _concat_datasets(datasets, results, columns=XERAWDP_COLUMNS):
+    
+    data = dict((key, np.concatenate([r[key] for r in results])) for key in columns)
+    df_xerawdp = pd.DataFrame(data, columns=columns)
+    df_xerawdp['dataset'] = np.repeat(datasets, [len(r[columns[0]]) for r in results])
+    return df_xerawdp
+
+def build_xerawdp_df_files(datasets, xerawdpPath, chunk_size=100000):
+    
+    # Serial version of build_xerawdp_df_parallel, one file open per dataset
+    results = _read_datasets(datasets, xerawdpPath, 1, chunk_size)
+    return _concat_datasets(datasets, results)
+
+def _read_datasets(datasets, xerawdpPath, n_workers=None, chunk_size=100000, worker=_read_dataset):
+    
+    # worker((dataset, xerawdpPath, chunk_size)) for every dataset, in order
+    tasks = [(dataset, xerawdpPath, chunk_size) for dataset in datasets]
+    if n_workers == 1:
+        return [worker(task) for task in tasks]
+    
+    # load (or build) the stl_loader library before the workers are forked
+    load_macro_cached(STL_LOADER)
+    
+    pool = Pool(n_workers)
+    try:
+        return pool.map(worker, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def build_xerawdp_df_parallel(datasets, xerawdpPath, n_workers=None, chunk_size=100000):
+    
+    # One xerawdp file per task; every worker applies the Kr selection and
+    # sends back only the selected columns, which are concatenated in the
+    # order of datasets with a dataset column added
+    results = _read_datasets(datasets, xerawdpPath, n_workers, chunk_size)
+    return _concat_datasets(datasets, results)
+
+def selection_hash():
+    
+    # changes whenever the code or the columns of the Kr selection change
+    import inspect
+    source = inspect.getsource(_jagged_head) + inspect.getsource(_preselection) \
+        + inspect.getsource(_select_chunk) + ','.join(XERAWDP_BRANCHES) + ','.join(XERAWDP_COLUMNS)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+def preselection_hash():
+    
+    # changes whenever the pre-selection (and so the entry lists) change
+    import inspect
+    source = inspect.getsource(_jagged_head) + inspect.getsource(_preselection) \
+        + inspect.getsource(selected_entries) + ','.join(PRESELECTION_BRANCHES)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+def _source_info(filename, selection):
+    # selection is the selection_hash / preselection_hash the data was made with
+    stat = os.stat(filename)
+    return dict(size=stat.st_size, mtime=stat.st_mtime, selection=selection)
+
+def _cache_valid(dataset_dir, filename, selection):
+    meta_file = os.path.join(dataset_dir, 'meta.json')
+    if not os.path.exists(meta_file) or not os.path.exists(filename):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    return meta == _source_info(filename, selection)
+
+def _write_cache(dataset_dir, filename, data, selection):
+    
+    # meta.json goes last, so an interrupted write is rebuilt on the next call
+    if not os.path.isdir(dataset_dir):
+        os.makedirs(dataset_dir)
+    meta_file = os.path.join(dataset_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    for key, values in data.items():
+        np.save(os.path.join(dataset_dir, key+'.npy'), values)
+    with open(meta_file, 'w') as f:
+        json.dump(_source_info(filename, selection), f)
+
+def load_xerawdp_columns(datasets, xerawdpPath, cache_dir='xerawdp_cache', columns=None,
+                         n_workers=1, chunk_size=100000):
+    
+    # Kr-selected xerawdp columns, one directory of .npy files per dataset.
+    # A dataset is rebuilt only if its file size / mtime or the selection
+    # code changed. Returns dataset -> dict(column -> memory-mapped array),
+    # so nothing is read from disk before a column is actually used.
+    if columns is None:
+        columns = XERAWDP_COLUMNS
+    
+    selection = selection_hash()
+    stale = [dataset for dataset in datasets
+             if not _cache_valid(os.path.join(cache_dir, dataset), xerawdpPath+dataset+'.root', selection)]
+    
+    if stale:
+        results = _read_datasets(stale, xerawdpPath, n_workers, chunk_size)
+        for dataset, data in zip(stale, results):
+            _write_cache(os.path.join(cache_dir, dataset), xerawdpPath+dataset+'.root', data, selection)
+    
+    return dict((dataset, dict((key, np.load(os.path.join(cache_dir, dataset, key+'.npy'), mmap_mode='r'))
+                               for key in columns)) for dataset in datasets)
+
+def load_xerawdp_cached(datasets, xerawdpPath, cache_dir='xerawdp_cache', columns=None,
+                        n_workers=1, chunk_size=100000):
+    
+    # load_xerawdp_columns as one DataFrame with a dataset column. Building
+    # it concatenates the columns, which reads all requested columns of all
+    # datasets into memory; use load_xerawdp_columns to stay on the
+    # memory maps.
+    if columns is None:
+        columns = XERAWDP_COLUMNS
+    data = load_xerawdp_columns(datasets, xerawdpPath, cache_dir, columns, n_workers, chunk_size)
+    return _concat_datasets(datasets, [data[dataset] for dataset in datasets], columns)
+
+##################################################################################################
+
+def selected_entries(xerawdpTree, chunk_size=100000):
+    
+    # Entry numbers passing the Kr pre-selection, from the three branches it
+    # needs only (read chunk_size entries at a time)
+    from root_numpy import tree2array
+    
+    entries = [np.zeros(0, dtype=np.int64)]
+    n_entries = xerawdpTree.GetEntries()
+    for start in range(0, n_entries, chunk_size):
+        arrays = tree2array(xerawdpTree, branches=PRESELECTION_BRANCHES,
+                            start=start, stop=min(start+chunk_size, n_entries))
+        s1_area = _jagged_head(arrays['S1sTot'], 1)[0][:, 0]
+        keep = _preselection(arrays['NbS1Peaks'], s1_area, arrays['NbS2Peaks'])
+        entries.append(start + np.flatnonzero(keep))
+    return np.concatenate(entries).astype(np.int64)
+
+def _dataset_entries(args):
+    
+    dataset, xerawdpPath, chunk_size = args
+    xerawdpFile, xerawdpTree = open_xerawdp_file(xerawdpPath+dataset+'.root', PRESELECTION_BRANCHES)
+    try:
+        return selected_entries(xerawdpTree, chunk_size)
+    finally:
+        xerawdpFile.Close()
+
+def load_entry_lists(datasets, xerawdpPath, cache_dir='xerawdp_entries', n_workers=1,
+                     chunk_size=100000):
+    
+    # Pre-selected entry numbers per dataset, computed once per file and kept
+    # in cache_dir/<dataset>/entries.npy; recomputed only if the file size /
+    # mtime or the pre-selection code changed
+    selection = preselection_hash()
+    stale = [dataset for dataset in datasets
+             if not _cache_valid(os.path.join(cache_dir, dataset), xerawdpPath+dataset+'.root', selection)]
+    
+    if stale:
+        results = _read_datasets(stale, xerawdpPath, n_workers, chunk_size, _dataset_entries)
+        for dataset, entries in zip(stale, results):
+            _write_cache(os.path.join(cache_dir, dataset), xerawdpPath+dataset+'.root',
+                         dict(entries=entries), selection)
+    
+    return dict((dataset, np.load(os.path.join(cache_dir, dataset, 'entries.npy')))
+                for dataset in datasets)
+
+def entry_list(xerawdpTree, entries):
+    
+    # TEntryList of entries for xerawdpTree, e.g. for
+    # xerawdpTree.SetEntryList(...) before Draw calls on the selected events
+    elist = ROOT.TEntryList('', '', xerawdpTree)
+    for entry in entries:
+        elist.Enter(int(entry))
+    return elist
+
+def build_xerawdp_df_selected(datasets, xerawdpPath, cache_dir='xerawdp_entries', n_workers=1,
+                              chunk_size=100000):
+    
+    # build_xerawdp_df over the datasets, visiting only the pre-selected
+    # entries, so rejected events are never read past the entry lists
+    entry_lists = load_entry_lists(datasets, xerawdpPath, cache_dir, n_workers, chunk_size)
+    
+    dfs = []
+    for dataset in datasets:
+        xerawdpFile, xerawdpTree = open_xerawdp_file(xerawdpPath+dataset+'.root')
+        try:
+            df_xerawdp = build_xerawdp_df(xerawdpTree, entry_lists[dataset].tolist())
+        finally:
+            xerawdpFile.Close()
+        df_xerawdp['dataset'] = dataset
+        dfs.append(df_xerawdp)
+    return pd.concat(dfs, ignore_index=True)
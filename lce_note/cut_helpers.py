@@ -1,4 +1,4 @@
-import ROOT
+from lazy_helpers import ROOT
 import numpy as  np
 
 def cut_compare(df_xerawdp,df_pax,cut_info):
@@ -0,0 +1,24 @@
+import importlib
+
+# Stand-ins for heavy modules (ROOT takes seconds to start, pandas a few
+# hundred ms) that import the real module on first attribute access. The
+# helper modules bind ROOT / pd to these, so importing their numeric
+# functions, in a notebook or in every pool worker, does not pay for ROOT.
+
+class LazyModule(object):
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module %r (%s)>' %(self._name, state)
+
+ROOT = LazyModule('ROOT')
+pd = LazyModule('pandas')
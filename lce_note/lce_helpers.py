@@ -1,17 +1,59 @@
 import numpy as np
 from collections import defaultdict
-import ROOT
+from lazy_helpers import ROOT, pd
 from subprocess import call
-import pandas as pd
 
 ##################################################################################################
 
 def atan(y, x):
     phi = np.arctan2(y, x)
-    for i in range(len(phi)):
-        if phi[i] < 0: 
-            phi[i] += 2*np.pi
-    return phi
+    return np.where(phi < 0, phi + 2*np.pi, phi)
+
+##################################################################################################
+
+def cylinder_bins(z, r, phi, bin_settings):
+    
+    # Flat bin id of every event for the (z, r, phi) bins of the lyBins loop,
+    # numbered in loop order (z_i, then r_i, then phi_i), -1 for events in no
+    # bin. Edges and open / closed sides are those of the loop:
+    # z_max <= z < z_min (z_width is negative), r_min < r <= r_max and
+    # phi_min < phi <= phi_max. Returns the ids and the number of bins.
+    R, Z, A_r, N_phi, N_z = bin_settings
+    z_width = Z / N_z
+    
+    z_edges = np.arange(int(N_z)+1) * z_width
+    if z_width < 0:
+        z_bin = np.searchsorted(-z_edges, -z, side='left') - 1
+    else:
+        # z_min < z_max, no event passes z < z_min and z >= z_max
+        z_bin = np.full(len(z), -1, dtype=np.int64)
+    z_bin[(z_bin < 0) | (z_bin >= int(N_z))] = -1
+    
+    r_edges = np.concatenate([[0], A_r])
+    r_bin = np.searchsorted(r_edges, r, side='left') - 1
+    r_bin[r_bin >= len(A_r)] = -1
+    
+    ring_offsets = np.concatenate([[0], np.cumsum(N_phi)]).astype(np.int64)
+    n_per_z = ring_offsets[-1]
+    
+    flat = np.full(len(z), -1, dtype=np.int64)
+    for r_i in range(len(A_r)):
+        ring = np.flatnonzero((r_bin == r_i) & (z_bin >= 0))
+        phi_edges = np.arange(N_phi[r_i]+1) * (2*np.pi/N_phi[r_i])
+        phi_bin = np.searchsorted(phi_edges, phi[ring], side='left') - 1
+        ok = (phi_bin >= 0) & (phi_bin < N_phi[r_i])
+        flat[ring[ok]] = z_bin[ring[ok]]*n_per_z + ring_offsets[r_i] + phi_bin[ok]
+    
+    return flat, int(N_z)*n_per_z
+
+def group_bins(flat, n_bins):
+    
+    # rows of the events of bin b are order[starts[b]:starts[b+1]], in
+    # table order (one stable sort for all bins)
+    valid = np.flatnonzero(flat >= 0)
+    order = valid[np.argsort(flat[valid], kind='mergesort')]
+    starts = np.concatenate([[0], np.cumsum(np.bincount(flat[valid], minlength=n_bins))])
+    return order, starts
 
 ##################################################################################################
 
@@ -36,13 +78,21 @@ def xe100_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
         return()
 
     bin_data = defaultdict(list)
+    
+    # every event's bin from one pass over the positions, all bins' events
+    # from one sort
+    x = df[position+'x'].values
+    y = df[position+'y'].values
+    flat, n_bins = cylinder_bins(df[position+'z'].values, np.sqrt(x**2 + y**2), atan(y, x), bin_settings)
+    order, starts = group_bins(flat, n_bins)
+    areas = df[peak+'Area'].values
+    b = 0
 
 
     for z_i in range(int(N_z)):
     
         z_min = z_i * z_width
         z_max = (z_i+1) * z_width
-        df_z = df[ (df[position+'z']<z_min) & (df[position+'z']>=z_max) ]
     
         for r_i in range(len(A_r)):
         
@@ -51,8 +101,6 @@ def xe100_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
             else:
                 r_min = A_r[r_i-1]
             r_max = A_r[r_i]
-            df_r = df_z[ ( np.sqrt(df_z[position+'x']**2 + df_z[position+'y']**2)>r_min )
-                       & ( np.sqrt(df_z[position+'x']**2 + df_z[position+'y']**2)<=r_max )]
         
             for phi_i in range(N_phi[r_i]):
             
@@ -66,17 +114,17 @@ def xe100_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
                 phi_max = (phi_i+1) * phi_widths[r_i] 
                 bin_data['phi'].append( (phi_max + phi_min)/2 )
             
-                df_phi = df_r[ (atan(df_r[position+'y'].values, df_r[position+'x'].values) > phi_min) 
-                             & (atan(df_r[position+'y'].values, df_r[position+'x'].values) <= phi_max )]
+                rows = order[starts[b]:starts[b+1]]
+                b += 1
             
-                bin_data['N'].append(len(df_phi))
+                bin_data['N'].append(len(rows))
                 
                 
                     
                 c1 = ROOT.TCanvas('','', 800, 700)
                 hist = ROOT.TH1D('','', 100, 0, s1_spec_max)
-                for i in range(len(df_phi[peak+'Area'])):
-                    hist.Fill(df_phi[peak+'Area'].values[i])
+                for area in areas[rows]:
+                    hist.Fill(area)
                 hist.SetTitle(peak+' Spectrum: \
                               %.1f > z > %.1f, %.1f < r < %.1f, %.1f < phi < %.1f,'
                               %(z_min, z_max, r_min, r_max, phi_min, phi_max))
@@ -108,7 +156,7 @@ def xe100_to_lyBins(df,bin_settings,peak,bin_spec_dir='Bin_Hists'):
                     e2 = fit.GetParError(2)
             
                     pt = ROOT.TPaveText(.58, .68, .88, .88, 'NDC')
-                    pt.AddText('Entries = %d'%len(df_phi))
+                    pt.AddText('Entries = %d'%len(rows))
                     pt.AddText('#mu = %1.3f #pm %1.3f'%(p1, e1))
                     pt.AddText('#sigma = %1.3f #pm %1.3f' %(p2, e2))
                     pt.AddText('Amplitude = %1.3f #pm %1.3f' %(p0, e0))
@@ -1,6 +1,5 @@
-import ROOT
+from lazy_helpers import ROOT, pd
 from collections import defaultdict
-import pandas as pd
 
 
 def load_xerawdp_tree(datasets,xerawdpPath):